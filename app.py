@@ -2,7 +2,9 @@
 import streamlit as st
 st.set_page_config(page_title="メビウス統合プロトタイプ", layout="wide")  # ← 最初に移動！
 
-from modules import board, karitunagari, chat
+from modules import board, karitunagari, chat, maintenance
+
+maintenance.start()  # WAL チェックポイント等のバックグラウンド処理（プロセスに 1 つ）
 
 st.title("🌌 メビウス α版")
 
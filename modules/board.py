@@ -1,21 +1,20 @@
 # board.py
 import streamlit as st
-import sqlite3
-import datetime
-import os
 import re
 import bcrypt
+from modules import maintenance, moderation, ratelimit, sessions
+from modules.storage import get_database
+from modules.timeutil import now_ms, ms_ago, ms_to_str
 
 DB_FILE = "db/board.db"
 ADMIN_USER = "admin"
 ADMIN_PASS = "admin123"
+DB = get_database("board", DB_FILE)
+_initialized = False
 
 # -------------------------------
 # ユーティリティ
 # -------------------------------
-def now_str():
-    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
 
@@ -31,153 +30,187 @@ def sanitize_message(text: str, max_len: int) -> str:
 # DB 接続と初期化
 # -------------------------------
 def get_conn():
-    new_db = not os.path.exists(DB_FILE)
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute("PRAGMA synchronous=NORMAL;")
-    if new_db:
-        conn.commit()
-    return conn
+    return DB.connect()
 
 def init_db():
-    conn = get_conn()
-    c = conn.cursor()
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS threads (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT,
-            created_at TEXT
-        )
-    """)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT,
-            message TEXT,
-            timestamp TEXT,
-            thread_id INTEGER
-        )
-    """)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            username TEXT PRIMARY KEY,
-            password TEXT
-        )
-    """)
-
-    c.execute("INSERT OR IGNORE INTO threads (id, title, created_at) VALUES (1, ?, ?)", ("雑談スレ", now_str()))
-
-    c.execute("SELECT password FROM users WHERE username=?", (ADMIN_USER,))
-    row = c.fetchone()
-    if row is None:
-        c.execute("INSERT INTO users (username, password) VALUES (?, ?)", (ADMIN_USER, hash_password(ADMIN_PASS)))
-    elif not is_bcrypt_hash(row[0]) and row[0] == ADMIN_PASS:
-        c.execute("UPDATE users SET password=? WHERE username=?", (hash_password(ADMIN_PASS), ADMIN_USER))
-
-    conn.commit()
-    conn.close()
+    # テーブル作成・時刻列の移行はプロセスごとに 1 回だけ（render のたびに走らせない）
+    global _initialized
+    if _initialized:
+        return
+    with get_conn() as conn:
+        c = conn.cursor()
+
+        c.execute(DB.ddl("""
+            CREATE TABLE IF NOT EXISTS threads (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT,
+                created_at TEXT,
+                created_ms BIGINT
+            )
+        """))
+        c.execute(DB.ddl("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT,
+                message TEXT,
+                timestamp TEXT,
+                thread_id INTEGER,
+                ts_ms BIGINT,
+                flagged INTEGER DEFAULT 0
+            )
+        """))
+        c.execute(DB.ddl("""
+            CREATE TABLE IF NOT EXISTS users (
+                username TEXT PRIMARY KEY,
+                password TEXT
+            )
+        """))
+
+        # 旧 TEXT 時刻（ローカル時刻）から整数ミリ秒列へ移行
+        DB.ensure_ms_column(c, "threads", "created_ms", "created_at", localtime=True)
+        DB.ensure_ms_column(c, "messages", "ts_ms", "timestamp", localtime=True)
+        DB.add_column(c, "messages", "flagged", "INTEGER DEFAULT 0")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_messages_thread_ts ON messages (thread_id, ts_ms)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages (ts_ms)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_threads_created ON threads (created_ms)")
+
+        # 複数レプリカが同時に初期化しても重複・IntegrityError にならないよう、既定スレは id=1 固定で ON CONFLICT
+        c.execute("INSERT INTO threads (id, title, created_ms) VALUES (1, ?, ?) ON CONFLICT (id) DO NOTHING",
+                  ("雑談スレ", now_ms()))
+        if c.rowcount == 1:
+            DB.sync_id_sequence(c, "threads")
+
+        c.execute("SELECT password FROM users WHERE username=?", (ADMIN_USER,))
+        row = c.fetchone()
+        if row is None:
+            c.execute("INSERT INTO users (username, password) VALUES (?, ?) ON CONFLICT (username) DO NOTHING",
+                      (ADMIN_USER, hash_password(ADMIN_PASS)))
+        elif not is_bcrypt_hash(row[0]) and row[0] == ADMIN_PASS:
+            c.execute("UPDATE users SET password=? WHERE username=?", (hash_password(ADMIN_PASS), ADMIN_USER))
+
+        conn.commit()
+    _initialized = True
 
 # -------------------------------
 # ユーザー認証
 # -------------------------------
 def check_user(username: str, password: str) -> bool:
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT password FROM users WHERE username=?", (username,))
-    row = c.fetchone()
-    if not row:
-        conn.close()
-        return False
-
-    stored = row[0]
-    ok = False
-    if is_bcrypt_hash(stored):
-        ok = bcrypt.checkpw(password.encode("utf-8"), stored.encode("utf-8"))
-    else:
-        ok = (stored == password)
-        if ok:
-            c.execute("UPDATE users SET password=? WHERE username=?", (hash_password(password), username))
-            conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT password FROM users WHERE username=?", (username,))
+        row = c.fetchone()
+        if not row:
+            return False
+
+        stored = row[0]
+        ok = False
+        if is_bcrypt_hash(stored):
+            ok = bcrypt.checkpw(password.encode("utf-8"), stored.encode("utf-8"))
+        else:
+            ok = (stored == password)
+            if ok:
+                c.execute("UPDATE users SET password=? WHERE username=?", (hash_password(password), username))
+                conn.commit()
     return ok
 
-def register_user(username: str, password: str) -> str:
+def register_user(username: str, password: str, client: str = "global") -> str:
     username = username.strip()
     password = password.strip()
     if not username or not password:
         return "ユーザー名とパスワードを入力してください。"
+    if not ratelimit.allow("board.register", client):
+        return "登録が混み合っています。しばらくしてから再度お試しください。"
 
-    conn = get_conn()
-    c = conn.cursor()
-    try:
-        c.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hash_password(password)))
-        conn.commit()
-        conn.close()
-        return "OK"
-    except sqlite3.IntegrityError as e:
-        conn.close()
-        return f"登録に失敗しました（既に存在 or DBエラー）: {str(e)}"
+    with get_conn() as conn:
+        c = conn.cursor()
+        try:
+            c.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hash_password(password)))
+            conn.commit()
+            return "OK"
+        except DB.IntegrityError as e:
+            return f"登録に失敗しました（既に存在 or DBエラー）: {str(e)}"
 
 def list_users():
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT username FROM users")
-    rows = c.fetchall()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT username FROM users")
+        rows = c.fetchall()
     return [r[0] for r in rows]
 
 # -------------------------------
 # メッセージ・スレッド処理
 # -------------------------------
-def save_message(username: str, message: str, thread_id: int):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("INSERT INTO messages (username, message, timestamp, thread_id) VALUES (?, ?, ?, ?)",
-              (username, message, now_str(), thread_id))
-    conn.commit()
-    conn.close()
+def save_message(username: str, message: str, thread_id: int, flagged: bool = False) -> bool:
+    if not ratelimit.allow("board.post", username):
+        return False
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO messages (username, message, ts_ms, thread_id, flagged) VALUES (?, ?, ?, ?, ?)",
+                  (username, message, now_ms(), thread_id, int(flagged)))
+        conn.commit()
+    return True
 
 def load_messages(thread_id: int):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT id, username, message, timestamp FROM messages WHERE thread_id=? ORDER BY id DESC", (thread_id,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, username, message, ts_ms, flagged FROM messages WHERE thread_id=? ORDER BY ts_ms DESC, id DESC", (thread_id,))
+        rows = c.fetchall()
+    return [(i, u, m, ms_to_str(ts), bool(f)) for i, u, m, ts, f in rows]
+
+def load_messages_since(thread_id: int, since_ms: int):
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, username, message, ts_ms, flagged FROM messages WHERE thread_id=? AND ts_ms>=? ORDER BY ts_ms DESC, id DESC",
+                  (thread_id, since_ms))
+        rows = c.fetchall()
+    return [(i, u, m, ms_to_str(ts), bool(f)) for i, u, m, ts, f in rows]
+
+def load_recent_messages(seconds: float = 3600):
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, username, message, ts_ms, flagged, thread_id FROM messages WHERE ts_ms>=? ORDER BY ts_ms DESC, id DESC",
+                  (ms_ago(seconds),))
+        rows = c.fetchall()
+    return [(i, u, m, ms_to_str(ts), bool(f), tid) for i, u, m, ts, f, tid in rows]
 
 def delete_message(msg_id: int):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("DELETE FROM messages WHERE id=?", (msg_id,))
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM messages WHERE id=?", (msg_id,))
+        conn.commit()
 
 def delete_all_messages():
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("DELETE FROM messages")
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM messages")
+        conn.commit()
 
 def load_threads(keyword: str = ""):
-    conn = get_conn()
-    c = conn.cursor()
-    if keyword:
-        like = f"%{keyword}%"
-        c.execute("SELECT id, title, created_at FROM threads WHERE title LIKE ? ORDER BY id DESC", (like,))
-    else:
-        c.execute("SELECT id, title, created_at FROM threads ORDER BY id DESC")
-    rows = c.fetchall()
-    conn.close()
-    return rows
-
-def create_thread(title: str):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("INSERT INTO threads (title, created_at) VALUES (?, ?)", (title, now_str()))
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        if keyword:
+            like = f"%{keyword}%"
+            c.execute("SELECT id, title, created_ms FROM threads WHERE title LIKE ? ORDER BY id DESC", (like,))
+        else:
+            c.execute("SELECT id, title, created_ms FROM threads ORDER BY id DESC")
+        rows = c.fetchall()
+    return [(i, t, ms_to_str(ms)) for i, t, ms in rows]
+
+def load_threads_since(since_ms: int):
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, title, created_ms FROM threads WHERE created_ms>=? ORDER BY created_ms DESC, id DESC", (since_ms,))
+        rows = c.fetchall()
+    return [(i, t, ms_to_str(ms)) for i, t, ms in rows]
+
+def create_thread(title: str, username: str = "global") -> bool:
+    if not ratelimit.allow("board.thread", username):
+        return False
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO threads (title, created_ms) VALUES (?, ?)", (title, now_ms()))
+        conn.commit()
+    return True
 
 # -------------------------------
 # UI
@@ -188,6 +221,7 @@ def rules_box():
 - 誹謗中傷・個人情報の投稿は禁止
 - スレッド名は **64文字まで**／メッセージは **150文字まで**
 - 画像・リンク貼付・改行はサポート外（テキストのみ）
+- 禁止語句は伏せ字になり、電話番号・メールアドレスを含む投稿は送信できません
 - 管理者が不適切な投稿を削除する場合があります
         """)
 
@@ -195,8 +229,8 @@ def main():
     st.title("匿名チャット（デモ版）")
     rules_box()
 
-    if "user" not in st.session_state:
-        st.session_state.user = None
+    # ログイン状態はサーバー側セッションから復元（掲示板のユーザー表でログインした場合のみ）
+    st.session_state.user = sessions.current_user("board")
     if "thread_id" not in st.session_state:
         st.session_state.thread_id = None
 
@@ -206,6 +240,7 @@ def main():
         login_pass = st.text_input("パスワード", type="password", key="login_pass")
         if st.button("ログイン"):
             if check_user(login_user, login_pass):
+                sessions.login("board", login_user)
                 st.session_state.user = login_user
                 st.success(f"{login_user} でログインしました")
                 st.rerun()
@@ -216,7 +251,7 @@ def main():
         new_user = st.text_input("新しいユーザー名", key="reg_user")
         new_pass = st.text_input("新しいパスワード", type="password", key="reg_pass")
         if st.button("登録"):
-            result = register_user(new_user, new_pass)
+            result = register_user(new_user, new_pass, ratelimit.client_key())
             if result == "OK":
                 st.success(f"{new_user} を登録しました。ログインしてください。")
             else:
@@ -226,6 +261,7 @@ def main():
     cols = st.columns([1,1,4])
     with cols[0]:
         if st.button("ログアウト"):
+            sessions.logout("board")
             st.session_state.user = None
             st.session_state.thread_id = None
             st.rerun()
@@ -235,6 +271,10 @@ def main():
         if st.session_state.user == ADMIN_USER:
             st.caption("登録済みユーザー一覧:")
             st.code("\n".join(list_users()))
+            st.caption("レート制限（許可/拒否）:")
+            st.json(ratelimit.stats())
+            st.caption("DB メンテナンス状況:")
+            st.table(maintenance.report())
 
     if st.session_state.thread_id is None:
         st.subheader("スレ一覧")
@@ -245,10 +285,14 @@ def main():
         new_thread = st.text_input("スレッド名（64文字まで）", key="thread_title_input", max_chars=64)
         if st.button("作成"):
             title = sanitize_message(new_thread, 64)
+            allowed, title, kinds = moderation.moderate(title)
             if not title:
                 st.warning("スレッド名を入力してください。")
+            elif not allowed:
+                st.error(moderation.reject_message(kinds))
+            elif not create_thread(title, st.session_state.user):
+                st.warning("スレッド作成が多すぎます。しばらくしてから再度お試しください。")
             else:
-                create_thread(title)
                 st.success("スレを作成しました")
                 st.rerun()
 
@@ -282,7 +326,13 @@ def main():
         if not msg:
             st.warning("メッセージを入力してください（150文字まで）。")
             return
-        save_message(st.session_state.user, msg, st.session_state.thread_id)
+        allowed, msg, kinds = moderation.moderate(msg)
+        if not allowed:
+            st.error(moderation.reject_message(kinds))
+            return
+        if not save_message(st.session_state.user, msg, st.session_state.thread_id, moderation.is_flagged(kinds)):
+            st.warning("投稿が多すぎます。少し待ってから送信してください。")
+            return
         st.session_state.input_message = ""
 
     # メッセージ入力欄
@@ -301,8 +351,9 @@ def main():
     if not messages:
         st.info("まだ投稿がありません。最初のメッセージをどうぞ！")
     else:
-        for msg_id, user, msg, ts in messages:
-            st.write(f"[{ts}] **{user}**: {msg}")
+        for msg_id, user, msg, ts, flagged in messages:
+            mark = "⚠ " if flagged and st.session_state.user == ADMIN_USER else ""
+            st.write(f"{mark}[{ts}] **{user}**: {msg}")
             if st.session_state.user == ADMIN_USER:
                 if st.button(f"削除 {msg_id}", key=f"del_{msg_id}"):
                     delete_message(msg_id)
@@ -1,8 +1,10 @@
 #chat.py
 import streamlit as st
-import sqlite3
 import bcrypt
 from streamlit_autorefresh import st_autorefresh
+from modules import moderation, ratelimit, sessions
+from modules.storage import get_database
+from modules.timeutil import now_ms
 
 # 🌙 ダークモード固定
 st.markdown("""
@@ -16,90 +18,162 @@ button { background-color: #426AB3 !important; color: #FFFFFF !important; border
 """, unsafe_allow_html=True)
 
 DB_PATH = "db/chat.db"
+NEW_DIVIDER_HTML = "<div style='text-align:center; color:#FF6B6B; margin:8px 0;'>―― ここから新着 ――</div>"
+DB = get_database("chat", DB_PATH)
+_initialized = False
+
+# 🧳 初期の db/chat.db は仮つながりと同じ形（kari_id / partner_id）の users・messages で作られている。
+#    チャットの列が無いと索引作成や読み書きが失敗するので、legacy_* に退避してから作り直す（データは残す）
+LEGACY_TABLES = {"users": "username", "messages": "sender"}  # テーブル -> チャット版にだけある列
+
+def _set_aside_legacy_tables(c):
+    for table, required in LEGACY_TABLES.items():
+        columns = DB.column_names(c, table)
+        if columns and required not in columns:
+            if DB.column_names(c, f"legacy_{table}"):
+                raise RuntimeError(f"chat: {table} が旧形式ですが legacy_{table} が既にあるため退避できません。手動で整理してください")
+            c.execute(f"ALTER TABLE {table} RENAME TO legacy_{table}")
 
 # 🔧 データベース初期化
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE,
-        password TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS messages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        sender TEXT,
-        receiver TEXT,
-        message TEXT,
-        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS friends (
-        user TEXT,
-        friend TEXT,
-        UNIQUE(user, friend))''')
-    conn.commit()
-    conn.close()
+    global _initialized
+    if _initialized:
+        return
+    with DB.connect() as conn:
+        c = conn.cursor()
+        _set_aside_legacy_tables(c)
+        c.execute(DB.ddl('''CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE,
+            password TEXT)'''))
+        c.execute(DB.ddl('''CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender TEXT,
+            receiver TEXT,
+            message TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            ts_ms BIGINT)'''))
+        # ⏱ 秒精度の DATETIME から整数ミリ秒列へ移行
+        DB.ensure_ms_column(c, "messages", "ts_ms", "timestamp")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_messages_pair_ts ON messages (sender, receiver, ts_ms)")
+        c.execute(DB.ddl('''CREATE TABLE IF NOT EXISTS friends (
+            "user" TEXT,
+            friend TEXT,
+            UNIQUE("user", friend))'''))
+        # 📬 既読カーソルと未読カウンタ（会話ごと・ユーザーごと）
+        c.execute(DB.ddl('''CREATE TABLE IF NOT EXISTS read_state (
+            "user" TEXT,
+            partner TEXT,
+            last_read_id INTEGER DEFAULT 0,
+            unread INTEGER DEFAULT 0,
+            PRIMARY KEY ("user", partner))'''))
+        conn.commit()
+    _initialized = True
 
 # 🆕 ユーザー登録
-def register_user(username, password):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    hashed_pw = bcrypt.hashpw(password.encode(), bcrypt.gensalt())
-    try:
-        c.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed_pw))
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
+def register_user(username, password, client="global"):
+    if not ratelimit.allow("chat.register", client):
         return False
-    finally:
-        conn.close()
+    with DB.connect() as conn:
+        c = conn.cursor()
+        hashed_pw = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode("utf-8")
+        try:
+            c.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed_pw))
+            conn.commit()
+            return True
+        except DB.IntegrityError:
+            return False
 
 # 🔐 ログイン
 def login_user(username, password):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT password FROM users WHERE username = ?", (username,))
-    result = c.fetchone()
-    conn.close()
-    if result and bcrypt.checkpw(password.encode("utf-8"), result[0]):
-        return True
-    return False
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute("SELECT password FROM users WHERE username = ?", (username,))
+        result = c.fetchone()
+    if not result:
+        return False
+    # 旧データは bytes（BLOB）で保存されている
+    stored = result[0] if isinstance(result[0], bytes) else result[0].encode("utf-8")
+    return bcrypt.checkpw(password.encode("utf-8"), stored)
 
 # 💬 メッセージ保存・取得
 def save_message(sender, receiver, message):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("INSERT INTO messages (sender, receiver, message) VALUES (?, ?, ?)", (sender, receiver, message))
-    conn.commit()
-    conn.close()
+    if not ratelimit.allow("chat.post", sender):
+        return False
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO messages (sender, receiver, message, ts_ms) VALUES (?, ?, ?, ?)",
+                  (sender, receiver, message, now_ms()))
+        if sender != receiver:
+            c.execute('''INSERT INTO read_state ("user", partner, unread) VALUES (?, ?, 1)
+                         ON CONFLICT("user", partner) DO UPDATE SET unread = read_state.unread + 1''', (receiver, sender))
+        conn.commit()
+    return True
 
 def get_messages(user, partner):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''SELECT sender, message, timestamp FROM messages
-                 WHERE (sender=? AND receiver=?) OR (sender=? AND receiver=?)
-                 ORDER BY timestamp''', (user, partner, partner, user))
-    messages = c.fetchall()
-    conn.close()
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute('''SELECT sender, message, ts_ms, id FROM messages
+                     WHERE (sender=? AND receiver=?) OR (sender=? AND receiver=?)
+                     ORDER BY ts_ms, id''', (user, partner, partner, user))
+        messages = c.fetchall()
     return messages
 
+def get_messages_since(user, partner, since_ms):
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute('''SELECT sender, message, ts_ms, id FROM messages
+                     WHERE ((sender=? AND receiver=?) OR (sender=? AND receiver=?)) AND ts_ms >= ?
+                     ORDER BY ts_ms, id''', (user, partner, partner, user, since_ms))
+        messages = c.fetchall()
+    return messages
+
+# 📬 既読・未読
+def mark_read(user, partner, last_id):
+    # 表示したメッセージ（id <= last_id）だけを既読にする。未読が無ければ書き込まない
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute('SELECT unread FROM read_state WHERE "user" = ? AND partner = ?', (user, partner))
+        row = c.fetchone()
+        if row and row[0] > 0:
+            c.execute('''UPDATE read_state SET last_read_id = ?,
+                             unread = (SELECT COUNT(*) FROM messages WHERE sender=? AND receiver=? AND id > ?)
+                         WHERE "user" = ? AND partner = ?''', (last_id, partner, user, last_id, user, partner))
+            conn.commit()
+
+def get_read_cursor(user, partner):
+    # 前回までに既読にした最後のメッセージ id（これより後の相手の発言が新着）
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute('SELECT last_read_id FROM read_state WHERE "user" = ? AND partner = ?', (user, partner))
+        row = c.fetchone()
+    return row[0] if row else 0
+
+def get_unread_counts(user):
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute('SELECT partner, unread FROM read_state WHERE "user" = ? AND unread > 0', (user,))
+        counts = dict(c.fetchall())
+    return counts
+
 # 👥 友達追加・取得
 def add_friend(user, friend):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    try:
-        c.execute("INSERT INTO friends (user, friend) VALUES (?, ?)", (user, friend))
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
+    if not ratelimit.allow("chat.friend", user):
         return False
-    finally:
-        conn.close()
+    with DB.connect() as conn:
+        c = conn.cursor()
+        try:
+            c.execute('INSERT INTO friends ("user", friend) VALUES (?, ?)', (user, friend))
+            conn.commit()
+            return True
+        except DB.IntegrityError:
+            return False
 
 def get_friends(user):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT friend FROM friends WHERE user = ?", (user,))
-    friends = [row[0] for row in c.fetchall()]
-    conn.close()
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute('SELECT friend FROM friends WHERE "user" = ?', (user,))
+        friends = [row[0] for row in c.fetchall()]
     return friends
 
 # 🖥 メイン画面
@@ -107,8 +181,7 @@ def render():
     init_db()
     st.title("1対1チャットSNSメビウス（α版）")
 
-    if "username" not in st.session_state:
-        st.session_state.username = None
+    st.session_state.username = sessions.current_user("chat")
     if "partner" not in st.session_state:
         st.session_state.partner = None
 
@@ -119,10 +192,10 @@ def render():
         new_user = st.text_input("ユーザー名を入力", key="register_username")
         new_pass = st.text_input("パスワードを入力", type="password", key="register_password")
         if st.button("登録", key="register_button"):
-            if register_user(new_user, new_pass):
+            if register_user(new_user, new_pass, ratelimit.client_key()):
                 st.success("登録成功！ログインしてください")
             else:
-                st.error("このユーザー名は既に使われています")
+                st.error("このユーザー名は既に使われているか、登録が混み合っています")
 
     elif menu == "ログイン":
         st.subheader("🔐 ログイン")
@@ -130,6 +203,7 @@ def render():
         pw = st.text_input("パスワード", type="password", key="login_password")
         if st.button("ログイン", key="login_button"):
             if login_user(user, pw):
+                sessions.login("chat", user)
                 st.session_state.username = user
                 st.success(f"{user} でログインしました！")
             else:
@@ -142,11 +216,19 @@ def render():
 
         with st.expander("👥 友達一覧を表示／非表示", expanded=True):
             friends = get_friends(st.session_state.username)
+            unread = get_unread_counts(st.session_state.username)
             if friends:
                 for f in friends:
-                    st.markdown(f"- `{f}`")
+                    badge = f" 🔴 未読 {unread[f]}" if unread.get(f) else ""
+                    st.markdown(f"- `{f}`{badge}")
             else:
                 st.info("まだ友達はいません。ユーザー名を入力して友達追加してください。")
+            # 友達登録は片方向なので、友達以外からの未読も見えるようにする
+            others = {p: n for p, n in unread.items() if p not in friends}
+            if others:
+                st.markdown("**📩 友達以外からの未読**")
+                for p, n in others.items():
+                    st.markdown(f"- `{p}` 🔴 未読 {n}")
 
         partner = st.text_input("チャット相手のユーザー名を入力", key="chat_partner_input")
         if partner:
@@ -157,11 +239,18 @@ def render():
                 if add_friend(st.session_state.username, partner):
                     st.success(f"{partner} を友達に追加しました！")
                 else:
-                    st.info(f"{partner} はすでに友達です")
+                    st.info(f"{partner} はすでに友達です（または操作が多すぎます）")
 
         if st.session_state.partner:
             messages = get_messages(st.session_state.username, st.session_state.partner)
-            for sender, msg, _ in messages:
+            last_read = get_read_cursor(st.session_state.username, st.session_state.partner)
+            mark_read(st.session_state.username, st.session_state.partner,
+                      max((m[3] for m in messages), default=0))
+            divider_shown = False
+            for sender, msg, _, msg_id in messages:
+                if not divider_shown and sender != st.session_state.username and msg_id > last_read:
+                    st.markdown(NEW_DIVIDER_HTML, unsafe_allow_html=True)
+                    divider_shown = True
                 align = "right" if sender == st.session_state.username else "left"
                 color = "#1F2F54" if sender == st.session_state.username else "#426AB3"
                 st.markdown(
@@ -177,8 +266,13 @@ def render():
 
             new_message = st.chat_input("メッセージを入力")
             if new_message:
-                save_message(st.session_state.username, st.session_state.partner, new_message)
-                st.rerun()
+                allowed, text, kinds = moderation.moderate(new_message, allow_flag=False)
+                if not allowed:
+                    st.error(moderation.reject_message(kinds))
+                elif save_message(st.session_state.username, st.session_state.partner, text):
+                    st.rerun()
+                else:
+                    st.warning("送信が多すぎます。少し待ってから送信してください。")
 
 # 実行
 if __name__ == "__main__":
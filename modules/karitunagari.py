@@ -1,8 +1,10 @@
 #karitunagari.py
 import streamlit as st
-import sqlite3
 import random
 from datetime import datetime
+from modules import moderation, ratelimit, sessions
+from modules.storage import get_database
+from modules.timeutil import now_ms
 
 # 🌙 ダークモード固定
 st.markdown("""
@@ -24,6 +26,10 @@ st.markdown("""
 </script>
 """, unsafe_allow_html=True)
 
+DB = get_database("karitunagari", "db/karitunagari.db")
+NEW_DIVIDER_HTML = "<div style='text-align:center; color:#FF6B6B; margin:8px 0;'>―― ここから新着 ――</div>"
+_initialized = False
+
 # 話題カードテンプレート
 topics = {
     "猫": ["猫派？犬派？", "飼ってる猫の名前は？", "猫の仕草で好きなものは？"],
@@ -52,119 +58,176 @@ topics = {
 
 # DB初期化
 def init_db():
-    conn = sqlite3.connect("db/karitunagari.db")
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-                    kari_id TEXT PRIMARY KEY,
-                    password TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    kari_id TEXT,
-                    partner_id TEXT,
-                    message TEXT,
-                    topic_theme TEXT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS friend_requests (
-                    from_id TEXT,
-                    to_id TEXT,
-                    status TEXT DEFAULT 'pending',
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS friends (
-                    user TEXT,
-                    friend TEXT,
-                    UNIQUE(user, friend))''')
-    conn.commit()
-    conn.close()
+    global _initialized
+    if _initialized:
+        return
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute(DB.ddl('''CREATE TABLE IF NOT EXISTS users (
+                        kari_id TEXT PRIMARY KEY,
+                        password TEXT)'''))
+        c.execute(DB.ddl('''CREATE TABLE IF NOT EXISTS messages (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        kari_id TEXT,
+                        partner_id TEXT,
+                        message TEXT,
+                        topic_theme TEXT,
+                        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        ts_ms BIGINT)'''))
+        c.execute(DB.ddl('''CREATE TABLE IF NOT EXISTS friend_requests (
+                        from_id TEXT,
+                        to_id TEXT,
+                        status TEXT DEFAULT 'pending',
+                        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        ts_ms BIGINT)'''))
+        # 秒精度の DATETIME から整数ミリ秒列へ移行
+        DB.ensure_ms_column(c, "messages", "ts_ms", "timestamp")
+        DB.ensure_ms_column(c, "friend_requests", "ts_ms", "timestamp")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_messages_pair_ts ON messages (kari_id, partner_id, ts_ms)")
+        c.execute(DB.ddl('''CREATE TABLE IF NOT EXISTS friends (
+                        "user" TEXT,
+                        friend TEXT,
+                        UNIQUE("user", friend))'''))
+        c.execute(DB.ddl('''CREATE TABLE IF NOT EXISTS read_state (
+                        kari_id TEXT,
+                        partner_id TEXT,
+                        last_read_id INTEGER DEFAULT 0,
+                        unread INTEGER DEFAULT 0,
+                        PRIMARY KEY (kari_id, partner_id))'''))
+        conn.commit()
+    _initialized = True
 
 # ユーザー登録・ログイン
-def register_user(kari_id, password):
-    conn = sqlite3.connect("db/karitunagari.db")
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE kari_id=?", (kari_id,))
-    if c.fetchone():
-        conn.close()
+def register_user(kari_id, password, client="global"):
+    if not ratelimit.allow("kari.register", client):
         return False
-    c.execute("INSERT INTO users (kari_id, password) VALUES (?, ?)", (kari_id, password))
-    conn.commit()
-    conn.close()
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM users WHERE kari_id=?", (kari_id,))
+        if c.fetchone():
+            return False
+        c.execute("INSERT INTO users (kari_id, password) VALUES (?, ?)", (kari_id, password))
+        conn.commit()
     return True
 
 def login_user(kari_id, password):
-    conn = sqlite3.connect("db/karitunagari.db")
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE kari_id=? AND password=?", (kari_id, password))
-    result = c.fetchone()
-    conn.close()
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM users WHERE kari_id=? AND password=?", (kari_id, password))
+        result = c.fetchone()
     return result is not None
 
 # メッセージ保存・取得
 def save_message(kari_id, partner_id, message, theme=None):
-    conn = sqlite3.connect("db/karitunagari.db")
-    c = conn.cursor()
-    c.execute("INSERT INTO messages (kari_id, partner_id, message, topic_theme) VALUES (?, ?, ?, ?)",
-              (kari_id, partner_id, message, theme))
-    conn.commit()
-    conn.close()
+    if not ratelimit.allow("kari.post", kari_id):
+        return False
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO messages (kari_id, partner_id, message, topic_theme, ts_ms) VALUES (?, ?, ?, ?, ?)",
+                  (kari_id, partner_id, message, theme, now_ms()))
+        if kari_id != partner_id:
+            c.execute('''INSERT INTO read_state (kari_id, partner_id, unread) VALUES (?, ?, 1)
+                         ON CONFLICT(kari_id, partner_id) DO UPDATE SET unread = read_state.unread + 1''',
+                      (partner_id, kari_id))
+        conn.commit()
+    return True
 
 def get_messages(kari_id, partner_id):
-    conn = sqlite3.connect("db/karitunagari.db")
-    c = conn.cursor()
-    c.execute('''SELECT kari_id, message FROM messages 
-                 WHERE (kari_id=? AND partner_id=?) OR (kari_id=? AND partner_id=?) 
-                 ORDER BY timestamp''',
-              (kari_id, partner_id, partner_id, kari_id))
-    messages = c.fetchall()
-    conn.close()
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute('''SELECT kari_id, message, id FROM messages 
+                     WHERE (kari_id=? AND partner_id=?) OR (kari_id=? AND partner_id=?) 
+                     ORDER BY ts_ms, id''',
+                  (kari_id, partner_id, partner_id, kari_id))
+        messages = c.fetchall()
+    return messages
+
+def get_messages_since(kari_id, partner_id, since_ms):
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute('''SELECT kari_id, message, id FROM messages 
+                     WHERE ((kari_id=? AND partner_id=?) OR (kari_id=? AND partner_id=?)) AND ts_ms >= ?
+                     ORDER BY ts_ms, id''',
+                  (kari_id, partner_id, partner_id, kari_id, since_ms))
+        messages = c.fetchall()
     return messages
 
 def get_shared_theme(kari_id, partner_id):
-    conn = sqlite3.connect("db/karitunagari.db")
-    c = conn.cursor()
-    c.execute('''SELECT topic_theme FROM messages 
-                 WHERE ((kari_id=? AND partner_id=?) OR (kari_id=? AND partner_id=?)) 
-                 AND topic_theme IS NOT NULL 
-                 ORDER BY timestamp LIMIT 1''',
-              (kari_id, partner_id, partner_id, kari_id))
-    result = c.fetchone()
-    conn.close()
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute('''SELECT topic_theme FROM messages 
+                     WHERE ((kari_id=? AND partner_id=?) OR (kari_id=? AND partner_id=?)) 
+                     AND topic_theme IS NOT NULL 
+                     ORDER BY ts_ms, id LIMIT 1''',
+                  (kari_id, partner_id, partner_id, kari_id))
+        result = c.fetchone()
     return result[0] if result else None
 
+# 既読・未読
+def mark_read(kari_id, partner_id, last_id):
+    # 表示したメッセージ（id <= last_id）だけを既読にする。未読が無ければ書き込まない
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute("SELECT unread FROM read_state WHERE kari_id=? AND partner_id=?", (kari_id, partner_id))
+        row = c.fetchone()
+        if row and row[0] > 0:
+            c.execute('''UPDATE read_state SET last_read_id = ?,
+                             unread = (SELECT COUNT(*) FROM messages WHERE kari_id=? AND partner_id=? AND id > ?)
+                         WHERE kari_id=? AND partner_id=?''',
+                      (last_id, partner_id, kari_id, last_id, kari_id, partner_id))
+            conn.commit()
+
+def get_read_cursor(kari_id, partner_id):
+    # 前回までに既読にした最後のメッセージ id（これより後の相手の発言が新着）
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute("SELECT last_read_id FROM read_state WHERE kari_id=? AND partner_id=?", (kari_id, partner_id))
+        row = c.fetchone()
+    return row[0] if row else 0
+
+def get_unread_counts(kari_id):
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute("SELECT partner_id, unread FROM read_state WHERE kari_id=? AND unread > 0", (kari_id,))
+        counts = dict(c.fetchall())
+    return counts
+
 # 友達申請・承認・取得
 def send_friend_request(from_id, to_id):
-    conn = sqlite3.connect("db/karitunagari.db")
-    c = conn.cursor()
-    c.execute("SELECT * FROM friend_requests WHERE from_id=? AND to_id=?", (from_id, to_id))
-    if c.fetchone():
-        conn.close()
+    if not ratelimit.allow("kari.friend_request", from_id):
         return False
-    c.execute("INSERT INTO friend_requests (from_id, to_id) VALUES (?, ?)", (from_id, to_id))
-    conn.commit()
-    conn.close()
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM friend_requests WHERE from_id=? AND to_id=?", (from_id, to_id))
+        if c.fetchone():
+            return False
+        c.execute("INSERT INTO friend_requests (from_id, to_id, ts_ms) VALUES (?, ?, ?)", (from_id, to_id, now_ms()))
+        conn.commit()
     return True
 
 def get_received_requests(my_id):
-    conn = sqlite3.connect("db/karitunagari.db")
-    c = conn.cursor()
-    c.execute("SELECT from_id FROM friend_requests WHERE to_id=? AND status='pending'", (my_id,))
-    requests = c.fetchall()
-    conn.close()
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute("SELECT from_id FROM friend_requests WHERE to_id=? AND status='pending'", (my_id,))
+        requests = c.fetchall()
     return [r[0] for r in requests]
 
 def approve_friend_request(my_id, from_id):
-    conn = sqlite3.connect("db/karitunagari.db")
-    c = conn.cursor()
-    c.execute("UPDATE friend_requests SET status='approved' WHERE from_id=? AND to_id=?", (from_id, my_id))
-    c.execute("INSERT OR IGNORE INTO friends (user, friend) VALUES (?, ?)", (my_id, from_id))
-    c.execute("INSERT OR IGNORE INTO friends (user, friend) VALUES (?, ?)", (from_id, my_id))
-    conn.commit()
-    conn.close()
+    if not ratelimit.allow("kari.friend_approve", my_id):
+        return False
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE friend_requests SET status='approved' WHERE from_id=? AND to_id=?", (from_id, my_id))
+        c.execute('INSERT INTO friends ("user", friend) VALUES (?, ?) ON CONFLICT DO NOTHING', (my_id, from_id))
+        c.execute('INSERT INTO friends ("user", friend) VALUES (?, ?) ON CONFLICT DO NOTHING', (from_id, my_id))
+        conn.commit()
+    return True
 
 def get_friends(my_id):
-    conn = sqlite3.connect("db/karitunagari.db")
-    c = conn.cursor()
-    c.execute("SELECT friend FROM friends WHERE user=?", (my_id,))
-    friends = c.fetchall()
-    conn.close()
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute('SELECT friend FROM friends WHERE "user"=?', (my_id,))
+        friends = c.fetchall()
     return [f[0] for f in friends]
 
 # ✅ メイン画面
@@ -174,6 +237,13 @@ def render():
 
     messages = []  # ← UnboundLocalError対策
 
+    # 自動更新で再読み込みされてもサーバー側セッションからログインを復元
+    session_user = sessions.current_user("karitunagari")
+    if session_user:
+        st.session_state.kari_id = session_user
+    else:
+        st.session_state.pop("kari_id", None)
+
     if "kari_id" in st.session_state:
         st.write(f"現在ログイン中： `{st.session_state.kari_id}`")
 
@@ -201,8 +271,14 @@ def render():
                     st.rerun()
 
             messages = get_messages(st.session_state.kari_id, partner)
+            last_read = get_read_cursor(st.session_state.kari_id, partner)
+            mark_read(st.session_state.kari_id, partner, max((m[2] for m in messages), default=0))
 
-            for sender, msg in messages:
+            divider_shown = False
+            for sender, msg, msg_id in messages:
+                if not divider_shown and sender != st.session_state.kari_id and msg_id > last_read:
+                    st.markdown(NEW_DIVIDER_HTML, unsafe_allow_html=True)
+                    divider_shown = True
                 align = "right" if sender == st.session_state.kari_id else "left"
                 bg = "#1F2F54" if align == "right" else "#426AB3"
                 msg_html = msg.replace("\n", "<br>")
@@ -220,8 +296,13 @@ def render():
             new_message = st.chat_input("メッセージを入力")
             if new_message:
                 theme_to_save = shared_theme or st.session_state.get("shared_theme")
-                save_message(st.session_state.kari_id, partner, new_message, theme_to_save)
-                st.rerun()
+                allowed, text, kinds = moderation.moderate(new_message, allow_flag=False)
+                if not allowed:
+                    st.error(moderation.reject_message(kinds))
+                elif save_message(st.session_state.kari_id, partner, text, theme_to_save):
+                    st.rerun()
+                else:
+                    st.warning("送信が多すぎます。少し待ってから送信してください。")
 
             if len(messages) >= 6:
                 st.success("この人と友達申請できます（3往復以上）")
@@ -229,7 +310,7 @@ def render():
                     if send_friend_request(st.session_state.kari_id, partner):
                         st.success("申請を送信しました！")
                     else:
-                        st.info("すでに申請済みです")
+                        st.info("すでに申請済みです（または操作が多すぎます）")
 
         # 🔔 申請受信一覧
         st.divider()
@@ -242,20 +323,24 @@ def render():
                     st.write(f"仮ID `{req}` から申請があります")
                 with col2:
                     if st.button(f"承認する（{req}）", key=f"approve_{req}"):
-                        approve_friend_request(st.session_state.kari_id, req)
-                        st.success(f"{req} を友達に追加しました！")
-                        st.rerun()
+                        if approve_friend_request(st.session_state.kari_id, req):
+                            st.success(f"{req} を友達に追加しました！")
+                            st.rerun()
+                        else:
+                            st.warning("操作が多すぎます。少し待ってから再度お試しください。")
         else:
             st.write("現在、受信した申請はありません。")
 
         # 👥 友達一覧表示（再接続ボタン付き）
         st.subheader("あなたの友達一覧")
         friends = get_friends(st.session_state.kari_id)
+        unread = get_unread_counts(st.session_state.kari_id)
         if friends:
             for f in friends:
                 col1, col2 = st.columns([3, 1])
                 with col1:
-                    st.write(f"仮ID `{f}` さん")
+                    badge = f" 🔴 未読 {unread[f]}" if unread.get(f) else ""
+                    st.write(f"仮ID `{f}` さん{badge}")
                 with col2:
                     if st.button(f"また話す（{f}）", key=f"chat_{f}"):
                         st.session_state.partner_id = f
@@ -263,6 +348,19 @@ def render():
         else:
             st.write("まだ友達はいません。")
 
+        # 📩 友達以外（仮つながり中の相手）からの未読
+        others = {p: n for p, n in unread.items() if p not in friends}
+        if others:
+            st.subheader("友達以外からの未読")
+            for p, n in others.items():
+                col1, col2 = st.columns([3, 1])
+                with col1:
+                    st.write(f"仮ID `{p}` さん 🔴 未読 {n}")
+                with col2:
+                    if st.button(f"話す（{p}）", key=f"unread_{p}"):
+                        st.session_state.partner_id = p
+                        st.rerun()
+
     else:
         # 🔐 ログイン画面
         st.subheader("🔐 ログイン")
@@ -270,6 +368,7 @@ def render():
         login_pw = st.text_input("パスワード", type="password")
         if st.button("ログインする"):
             if login_user(login_id, login_pw):
+                sessions.login("karitunagari", login_id)
                 st.session_state.kari_id = login_id
                 st.success(f"ようこそ、{login_id} さん！")
                 st.rerun()
@@ -281,10 +380,11 @@ def render():
         new_id = st.text_input("仮IDを入力（例：赤い猫）")
         new_pw = st.text_input("パスワードを入力", type="password")
         if st.button("登録する"):
-            if register_user(new_id, new_pw):
+            if register_user(new_id, new_pw, ratelimit.client_key()):
                 st.success("登録が完了しました！ログインしてください")
             else:
-                st.error("その仮IDはすでに使われています")
+                st.error("その仮IDはすでに使われているか、登録が混み合っています")
 
 # 実行
-render()
\ No newline at end of file
+if __name__ == "__main__":
+    render()
\ No newline at end of file
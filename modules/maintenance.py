@@ -0,0 +1,157 @@
+# maintenance.py
+# SQLite のバックグラウンドメンテナンス
+#   CHECKPOINT_INTERVAL_SEC ごと : PASSIVE チェックポイント（書き込みを止めない）
+#   閑散時間帯に 1 日 1 回         : TRUNCATE チェックポイント・ANALYZE / PRAGMA optimize・incremental vacuum
+#   WAL が WAL_TRUNCATE_BYTES を超えたら時間帯に関係なく TRUNCATE
+#   SESSION_PURGE_INTERVAL_SEC ごと : 期限切れセッションの削除（PostgreSQL でも実行）
+# PostgreSQL の DB 自体は autovacuum に任せる
+import datetime
+import os
+import threading
+import time
+from modules import sessions, storage
+from modules.timeutil import now_ms, ms_to_str
+
+def _parse_hours(value: str):
+    # "開始-終了" を (開始, 終了) に。起動時に検証して、設定ミスをスレッド内の例外にしない
+    start, sep, end = value.partition("-")
+    try:
+        hours = (int(start), int(end)) if sep else None
+    except ValueError:
+        hours = None
+    if hours is None or not all(0 <= h <= 24 for h in hours):
+        raise ValueError(f"MEBIUS_LOW_TRAFFIC_HOURS は '3-5' のような 開始-終了 の時刻で指定してください: {value!r}")
+    return hours
+
+CHECKPOINT_INTERVAL_SEC = int(os.environ.get("MEBIUS_CHECKPOINT_INTERVAL_SEC", "60"))
+LOW_TRAFFIC_HOURS = _parse_hours(os.environ.get("MEBIUS_LOW_TRAFFIC_HOURS", "3-5"))  # ローカル時刻、開始-終了（終了を含まない）
+WAL_TRUNCATE_BYTES = int(os.environ.get("MEBIUS_WAL_TRUNCATE_BYTES", str(64 * 1024 * 1024)))
+VACUUM_PAGES = 1000  # 1 回の incremental vacuum で解放する最大ページ数
+SESSION_PURGE_INTERVAL_SEC = int(os.environ.get("MEBIUS_SESSION_PURGE_INTERVAL_SEC", "3600"))
+
+_lock = threading.Lock()
+_thread = None
+_status = {}  # DB 名 -> 最終実行結果
+_last_purge_ms = 0
+
+# -------------------------------
+# 個別タスク
+# -------------------------------
+def _sqlite_databases():
+    return [db for db in storage.DATABASES if isinstance(db, storage.SQLiteDatabase) and os.path.exists(db.path)]
+
+def _in_low_traffic_window(now: datetime.datetime) -> bool:
+    start, end = LOW_TRAFFIC_HOURS
+    if start <= end:
+        return start <= now.hour < end
+    return now.hour >= start or now.hour < end
+
+def checkpoint(db, mode: str = "PASSIVE"):
+    with db.connect() as conn:
+        busy, log_pages, done_pages = conn.execute(f"PRAGMA wal_checkpoint({mode});").fetchone()
+    _record(db, f"checkpoint_{mode.lower()}", {"busy": busy, "wal_pages": log_pages, "checkpointed": done_pages})
+
+def optimize(db):
+    with db.connect() as conn:
+        has_stats = conn.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone()
+        if has_stats:
+            conn.execute("PRAGMA analysis_limit=1000;")
+            conn.execute("PRAGMA optimize;")
+        else:
+            conn.execute("ANALYZE;")
+        conn.commit()
+    _record(db, "optimize", {})
+
+def vacuum(db):
+    with db.connect() as conn:
+        mode = conn.execute("PRAGMA auto_vacuum;").fetchone()[0]
+        if mode != 2:
+            # 既存 DB を INCREMENTAL に切り替えるには一度だけ VACUUM が必要
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+            conn.execute("VACUUM;")
+        else:
+            # execute() は 1 ステップ（1 ページ）で止まるので、executescript で最後まで実行する
+            conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES});")
+        conn.commit()
+    _record(db, "vacuum", {"switched_to_incremental": mode != 2})
+
+def purge_sessions():
+    global _last_purge_ms
+    deleted = sessions.purge_expired()
+    _last_purge_ms = now_ms()
+    _record(sessions.DB, "purge_sessions", {"deleted": deleted})
+
+def _record(db, task: str, detail: dict):
+    with _lock:
+        _status.setdefault(db.name, {})[task] = (now_ms(), detail)
+
+# -------------------------------
+# スケジューラ
+# -------------------------------
+def run_once(now: datetime.datetime = None, deep: bool = None):
+    now = now or datetime.datetime.now()
+    if now_ms() - _last_purge_ms >= SESSION_PURGE_INTERVAL_SEC * 1000:
+        try:
+            purge_sessions()
+        except Exception as e:
+            _record(sessions.DB, "error", {"message": str(e)})
+    for db in _sqlite_databases():
+        try:
+            wal_path = db.path + "-wal"
+            wal_size = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+            last_deep = _status.get(db.name, {}).get("optimize", (0, None))[0]
+            run_deep = deep if deep is not None else (
+                _in_low_traffic_window(now) and now_ms() - last_deep > 20 * 3600 * 1000)
+            if run_deep:
+                optimize(db)
+                vacuum(db)
+                checkpoint(db, "TRUNCATE")
+            elif wal_size > WAL_TRUNCATE_BYTES:
+                checkpoint(db, "TRUNCATE")
+            else:
+                checkpoint(db, "PASSIVE")
+        except Exception as e:
+            # OSError（WAL ファイルの消失など）でも他の DB のメンテナンスは続ける
+            _record(db, "error", {"message": str(e)})
+
+def _loop():
+    # 例外でスレッドが黙って止まらないよう、想定外のエラーも記録して次の周期へ
+    while True:
+        time.sleep(CHECKPOINT_INTERVAL_SEC)
+        try:
+            run_once()
+        except Exception as e:
+            with _lock:
+                _status.setdefault("scheduler", {})["error"] = (now_ms(), {"message": f"{type(e).__name__}: {e}"})
+
+def start():
+    # Streamlit の再実行ごとに呼ばれても、スレッドはプロセスに 1 つだけ
+    global _thread
+    with _lock:
+        if _thread is not None and _thread.is_alive():
+            return
+        _thread = threading.Thread(target=_loop, name="db-maintenance", daemon=True)
+        _thread.start()
+
+# -------------------------------
+# レポート
+# -------------------------------
+def report():
+    rows = []
+    for db in _sqlite_databases():
+        wal_path = db.path + "-wal"
+        with db.connect() as conn:
+            freelist = conn.execute("PRAGMA freelist_count;").fetchone()[0]
+            page_size = conn.execute("PRAGMA page_size;").fetchone()[0]
+        with _lock:
+            status = dict(_status.get(db.name, {}))
+        rows.append({
+            "db": db.name,
+            "db_bytes": os.path.getsize(db.path),
+            "wal_bytes": os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+            "free_bytes": freelist * page_size,
+            "last_checkpoint": ms_to_str(max((status[k][0] for k in status if k.startswith("checkpoint")), default=None)),
+            "last_optimize": ms_to_str(status.get("optimize", (None,))[0]),
+            "last_error": status.get("error", (None, {}))[1].get("message", ""),
+        })
+    return rows
@@ -0,0 +1,184 @@
+# moderation.py
+# 投稿前の NG ワード・個人情報フィルタ
+#   NG ワード: Aho–Corasick オートマトンで 1 パス照合（ng_words.txt を更新すると自動で再構築）
+#   個人情報: 電話番号・メールアドレスを正規表現で検出
+#   検出時の扱いは POLICY で種類ごとに "reject"（拒否）/ "mask"（伏せ字）/ "flag"（印を付けて通す）
+#   flag を保存できるのは掲示板だけ。チャット・仮つながりは moderate(..., allow_flag=False) で呼び、flag は mask として扱う
+import os
+import re
+import threading
+import unicodedata
+from collections import deque
+
+NG_WORDS_FILE = os.environ.get("MEBIUS_NG_WORDS", os.path.join(os.path.dirname(__file__), "ng_words.txt"))
+POLICY = {
+    "ng_word": "mask",
+    "phone": "reject",
+    "email": "reject",
+}
+MASK_CHAR = "＊"
+
+# 電話番号は日本の番号の形だけ:
+#   0 始まりで区切りなし 10〜11 桁 / 市外局番-市内局番-4 桁 / (市外局番)市内局番-4 桁 / 0120・0800-3 桁-3 桁
+#   区切りは - . 空白、+81 で始まる国際表記（+81-90-…、+81 (0)3 …）も国内の番号に直して判定する
+# （数字の合計が 10〜11 桁のものだけを電話番号とみなす → 日付やスコアは対象外）
+_SEP = r"[-. ]"
+_LOCAL = (rf"\d{{1,4}}{_SEP}\d{{1,4}}{_SEP}\d{{4}}|\(\d{{1,4}}\) ?\d{{1,4}}{_SEP}\d{{4}}"
+          rf"|(?:120|800){_SEP}?\d{{3}}{_SEP}?\d{{3}}|\d{{9,10}}")
+PII_PATTERN = re.compile(
+    r"(?P<email>[A-Za-z0-9._%+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)+)"
+    rf"|(?P<phone>(?<![\d-])(?:0(?:{_LOCAL})|\(0(?:\d{{1,4}}\) ?\d{{1,4}}{_SEP}\d{{4}})"
+    rf"|\+81{_SEP}?(?:\(0\) ?)?(?:{_LOCAL}))(?![\d-]))"
+)
+PHONE_DIGITS = (10, 11)
+
+# -------------------------------
+# Aho–Corasick
+# -------------------------------
+class Automaton:
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]  # ノードごとに一致する語の長さ
+        for word in words:
+            self._add(word)
+        self._build()
+
+    def _add(self, word: str):
+        node = 0
+        for ch in word:
+            nxt = self.goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+            node = nxt
+        self.out[node].append(len(word))
+
+    def _build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+                queue.append(nxt)
+
+    def find(self, text: str):
+        # (開始位置, 終了位置) のリストを返す
+        spans = []
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            for length in self.out[node]:
+                spans.append((i - length + 1, i + 1))
+        return spans
+
+# -------------------------------
+# NG ワードリストの読み込み
+# -------------------------------
+# ひらがな（ぁ〜ゖ、ゝゞ）をカタカナに寄せ、NG ワード 1 語で両方の表記に一致させる
+KANA_FOLD = {cp: cp + 0x60 for cp in [*range(0x3041, 0x3097), 0x309D, 0x309E]}
+
+_lock = threading.Lock()
+_automaton = Automaton([])
+_loaded_mtime = None
+
+def _normalize_with_spans(text: str):
+    # 文字と後ろに続く結合文字（半角の濁点・半濁点など）をまとめて NFKC + 小文字化 + ひらがな→カタカナし、
+    # 正規化後の各文字が元の text のどの範囲から来たかを記録する（ﾊﾞｶ・ばか → バカ、ＡＢＣ → abc）
+    out, spans = [], []
+    i = 0
+    while i < len(text):
+        j = i + 1
+        while j < len(text) and unicodedata.combining(unicodedata.normalize("NFKC", text[j])[0]):
+            j += 1
+        for ch in unicodedata.normalize("NFKC", text[i:j]).lower().translate(KANA_FOLD):
+            out.append(ch)
+            spans.append((i, j))
+        i = j
+    return "".join(out), spans
+
+def normalize(text: str) -> str:
+    return _normalize_with_spans(text)[0]
+
+def _phone_digits(match: str) -> str:
+    # 国内表記の数字列に直す（+81 90… → 090…、+81 (0)3… → 03…）
+    digits = re.sub(r"\D", "", match)
+    if match.startswith("+81"):
+        digits = "0" + digits[2:].removeprefix("0")
+    return digits
+
+def load_words(path: str = None):
+    path = path or NG_WORDS_FILE
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    return [normalize(line) for line in lines if line and not line.startswith("#")]
+
+def reload(path: str = None):
+    global _automaton, _loaded_mtime
+    path = path or NG_WORDS_FILE
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    automaton = Automaton(load_words(path))
+    with _lock:
+        _automaton = automaton
+        _loaded_mtime = mtime
+
+def _current_automaton():
+    mtime = os.path.getmtime(NG_WORDS_FILE) if os.path.exists(NG_WORDS_FILE) else None
+    if mtime != _loaded_mtime:
+        reload()
+    return _automaton
+
+# -------------------------------
+# フィルタ本体
+# -------------------------------
+def scan(text: str):
+    # [(種類, 開始, 終了)] を返す（位置は元の text 上）
+    normalized, spans = _normalize_with_spans(text)
+    found = [("ng_word", s, e) for s, e in _current_automaton().find(normalized)]
+    for m in PII_PATTERN.finditer(normalized):
+        if m.lastgroup == "phone" and len(_phone_digits(m.group())) not in PHONE_DIGITS:
+            continue
+        found.append((m.lastgroup, m.start(), m.end()))
+    return [(kind, spans[s][0], spans[e - 1][1]) for kind, s, e in found]
+
+def _action(kind: str, allow_flag: bool) -> str:
+    action = POLICY.get(kind)
+    return "mask" if action == "flag" and not allow_flag else action
+
+def moderate(text: str, allow_flag: bool = True):
+    """(許可するか, 保存するテキスト, 検出した種類の一覧) を返す"""
+    hits = scan(text)
+    kinds = sorted({kind for kind, _, _ in hits})
+    if any(_action(kind, allow_flag) == "reject" for kind in kinds):
+        return False, text, kinds
+    chars = list(text)
+    for kind, start, end in hits:
+        if _action(kind, allow_flag) == "mask":
+            chars[start:end] = MASK_CHAR * (end - start)
+    return True, "".join(chars), kinds
+
+def is_flagged(kinds) -> bool:
+    return any(POLICY.get(kind) == "flag" for kind in kinds)
+
+REJECT_MESSAGES = {
+    "phone": "電話番号らしき内容が含まれているため投稿できません。",
+    "email": "メールアドレスが含まれているため投稿できません。",
+    "ng_word": "禁止語句が含まれているため投稿できません。",
+}
+
+def reject_message(kinds) -> str:
+    for kind in kinds:
+        if POLICY.get(kind) == "reject":
+            return REJECT_MESSAGES.get(kind, "この内容は投稿できません。")
+    return ""
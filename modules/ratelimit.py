@@ -0,0 +1,93 @@
+# ratelimit.py
+# 書き込み系の操作をユーザー×操作ごとのトークンバケットで制限する（プロセス内メモリ）
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# 操作ごとの上限: (バケット容量, 1秒あたりの補充数)
+LIMITS = {
+    "board.post": (5, 0.5),
+    "board.thread": (2, 1 / 30),
+    "board.register": (10, 0.2),
+    "chat.post": (10, 1.0),
+    "chat.friend": (5, 0.2),
+    "chat.register": (10, 0.2),
+    "kari.post": (10, 1.0),
+    "kari.friend_request": (5, 0.2),
+    "kari.friend_approve": (10, 0.5),
+    "kari.register": (10, 0.2),
+}
+DEFAULT_LIMIT = (10, 1.0)
+MAX_BUCKETS = int(os.environ.get("MEBIUS_RATELIMIT_MAX_BUCKETS", "10000"))
+# 手前にあるリバースプロキシの段数。0（既定）なら X-Forwarded-For は偽装できるので使わない
+TRUSTED_PROXY_HOPS = int(os.environ.get("MEBIUS_TRUSTED_PROXY_HOPS", "0"))
+
+_lock = threading.Lock()
+_buckets = OrderedDict()  # (action, key) -> [tokens, last_refill]（古い順）
+_allowed = {}   # action -> 許可数
+_rejected = {}  # action -> 拒否数
+
+def configure(action: str, capacity: float, refill_per_sec: float):
+    with _lock:
+        LIMITS[action] = (capacity, refill_per_sec)
+        for bucket_key in [k for k in _buckets if k[0] == action]:
+            del _buckets[bucket_key]
+
+def _evict(now: float):
+    # 満タンまで回復したバケットは作り直しても同じなので捨てる。それでも多ければ古い順に 1 割捨てる
+    for bucket_key, (tokens, last) in list(_buckets.items()):
+        capacity, rate = LIMITS.get(bucket_key[0], DEFAULT_LIMIT)
+        if tokens + (now - last) * rate >= capacity:
+            del _buckets[bucket_key]
+    while len(_buckets) >= MAX_BUCKETS * 0.9:
+        _buckets.popitem(last=False)
+
+def allow(action: str, key: str = "global") -> bool:
+    capacity, rate = LIMITS.get(action, DEFAULT_LIMIT)
+    now = time.monotonic()
+    with _lock:
+        bucket = _buckets.get((action, key))
+        if bucket is None:
+            if len(_buckets) >= MAX_BUCKETS:
+                _evict(now)
+            bucket = _buckets[(action, key)] = [capacity, now]
+        else:
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            _buckets.move_to_end((action, key))
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            _allowed[action] = _allowed.get(action, 0) + 1
+            return True
+        _rejected[action] = _rejected.get(action, 0) + 1
+        return False
+
+def client_key() -> str:
+    # 登録などログイン前の操作用のキー
+    #   TRUSTED_PROXY_HOPS 段のプロキシ経由なら X-Forwarded-For の末尾から数えた接続元、
+    #   なければ接続元 IP、それも取れなければ Streamlit のセッション ID
+    import streamlit as st
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    try:
+        if TRUSTED_PROXY_HOPS > 0:
+            hops = [h.strip() for h in st.context.headers.get("X-Forwarded-For", "").split(",") if h.strip()]
+            if len(hops) >= TRUSTED_PROXY_HOPS:
+                return "ip:" + hops[-TRUSTED_PROXY_HOPS]
+        if st.context.ip_address:
+            return "ip:" + st.context.ip_address
+    except Exception:
+        pass
+    ctx = get_script_run_ctx()
+    return "session:" + ctx.session_id if ctx else "global"
+
+def stats():
+    with _lock:
+        actions = set(_allowed) | set(_rejected)
+        return {a: {"allowed": _allowed.get(a, 0), "rejected": _rejected.get(a, 0)} for a in sorted(actions)}
+
+def reset():
+    with _lock:
+        _buckets.clear()
+        _allowed.clear()
+        _rejected.clear()
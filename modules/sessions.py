@@ -0,0 +1,164 @@
+# sessions.py
+# サーバー側セッションストア
+#   署名付きトークン（"<セッションID>.<HMAC>"）を URL の ?sid= に載せ、中身は共有 DB に置く
+#   → どのプロセス／ホストに振り分けられても、再読み込みしてもログイン状態を復元できる
+#   掲示板・仮つながり・チャットはユーザー表もパスワードも別なので、ログインはセクションごとに記録する
+#   （1 つのトークンに "board" / "chat" / "karitunagari" それぞれのログインをぶら下げる。
+#     あるセクションでのログインが他のセクションの同名ユーザーとして扱われることはない）
+#   ログインのたびにセッション ID を作り直す（URL で渡されたトークンにログインが追加されるセッション固定攻撃を防ぐ）
+import hashlib
+import hmac
+import os
+import secrets
+import warnings
+import streamlit as st
+from modules import storage
+from modules.storage import get_database
+from modules.timeutil import now_ms
+
+SECRET = os.environ.get("MEBIUS_SESSION_SECRET", "")
+if not SECRET:
+    if storage.BACKEND != "sqlite":
+        raise RuntimeError("共有 DB で複数プロセスを動かす場合は MEBIUS_SESSION_SECRET を全プロセス共通で設定してください")
+    warnings.warn("MEBIUS_SESSION_SECRET が未設定のため一時的な鍵を使います。"
+                  "再起動すると全員ログアウトされ、他のプロセスとはログインを共有できません。", RuntimeWarning)
+    SECRET = secrets.token_hex(32)
+SESSION_TTL_SEC = int(os.environ.get("MEBIUS_SESSION_TTL_SEC", str(7 * 24 * 3600)))
+RECHECK_SEC = 60
+QUERY_KEY = "sid"
+SECTIONS = ("board", "chat", "karitunagari")
+
+DB = get_database("sessions", "db/sessions.db")
+_initialized = False
+
+# -------------------------------
+# DB
+# -------------------------------
+def init_db():
+    global _initialized
+    if _initialized:
+        return
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute(DB.ddl("""
+            CREATE TABLE IF NOT EXISTS session_logins (
+                id TEXT,
+                section TEXT,
+                username TEXT,
+                created_ms BIGINT,
+                expires_ms BIGINT,
+                PRIMARY KEY (id, section)
+            )
+        """))
+        c.execute("CREATE INDEX IF NOT EXISTS idx_session_logins_expires ON session_logins (expires_ms)")
+        conn.commit()
+    _initialized = True
+
+# -------------------------------
+# トークン
+# -------------------------------
+def _sign(session_id: str) -> str:
+    return hmac.new(SECRET.encode("utf-8"), session_id.encode("utf-8"), hashlib.sha256).hexdigest()
+
+def _verify(token: str):
+    session_id, _, sig = (token or "").partition(".")
+    if not session_id or not hmac.compare_digest(sig, _sign(session_id)):
+        return None
+    return session_id
+
+def create_session(section: str, username: str, token: str = None) -> str:
+    # 常に新しいセッション ID を発行する。有効なトークンがあれば他セクションのログインを引き継ぎ、古い ID は消す
+    if section not in SECTIONS:
+        raise ValueError(f"unknown section: {section}")
+    init_db()
+    old_id = _verify(token)
+    session_id = secrets.token_urlsafe(24)
+    now = now_ms()
+    with DB.connect() as conn:
+        c = conn.cursor()
+        if old_id:
+            c.execute("""
+                INSERT INTO session_logins (id, section, username, created_ms, expires_ms)
+                SELECT ?, section, username, created_ms, expires_ms FROM session_logins
+                WHERE id=? AND section<>? AND expires_ms>?
+            """, (session_id, old_id, section, now))
+            c.execute("DELETE FROM session_logins WHERE id=?", (old_id,))
+        c.execute("""
+            INSERT INTO session_logins (id, section, username, created_ms, expires_ms) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (id, section) DO UPDATE SET
+                username = excluded.username, created_ms = excluded.created_ms, expires_ms = excluded.expires_ms
+        """, (session_id, section, username, now, now + SESSION_TTL_SEC * 1000))
+        conn.commit()
+    return f"{session_id}.{_sign(session_id)}"
+
+def get_session_user(token: str, section: str):
+    session_id = _verify(token)
+    if session_id is None:
+        return None
+    init_db()
+    now = now_ms()
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute("SELECT username, expires_ms FROM session_logins WHERE id=? AND section=?", (session_id, section))
+        row = c.fetchone()
+        if row is None or row[1] <= now:
+            return None
+        # 残り時間が半分を切ったら延長（毎回は書き込まない）
+        if row[1] - now < SESSION_TTL_SEC * 500:
+            c.execute("UPDATE session_logins SET expires_ms=? WHERE id=? AND section=?",
+                      (now + SESSION_TTL_SEC * 1000, session_id, section))
+            conn.commit()
+    return row[0]
+
+def delete_session(token: str, section: str = None):
+    # section を省略するとトークンに紐づく全セクションからログアウト
+    session_id = _verify(token)
+    if session_id is None:
+        return
+    init_db()
+    with DB.connect() as conn:
+        c = conn.cursor()
+        if section is None:
+            c.execute("DELETE FROM session_logins WHERE id=?", (session_id,))
+        else:
+            c.execute("DELETE FROM session_logins WHERE id=? AND section=?", (session_id, section))
+        conn.commit()
+
+def purge_expired() -> int:
+    init_db()
+    with DB.connect() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM session_logins WHERE expires_ms<=?", (now_ms(),))
+        deleted = c.rowcount
+        conn.commit()
+    return deleted
+
+# -------------------------------
+# Streamlit 連携
+# -------------------------------
+def _cache():
+    if "_session_cache" not in st.session_state:
+        st.session_state._session_cache = {}
+    return st.session_state._session_cache
+
+def current_user(section: str):
+    token = st.query_params.get(QUERY_KEY)
+    if not token:
+        return None
+    cached = _cache().get(section)
+    if cached and cached[0] == token and now_ms() - cached[2] < RECHECK_SEC * 1000:
+        return cached[1]
+    user = get_session_user(token, section)
+    _cache()[section] = (token, user, now_ms())
+    return user
+
+def login(section: str, username: str):
+    token = create_session(section, username, st.query_params.get(QUERY_KEY))
+    st.query_params[QUERY_KEY] = token
+    _cache()[section] = (token, username, now_ms())
+
+def logout(section: str):
+    token = st.query_params.get(QUERY_KEY)
+    if token:
+        delete_session(token, section)
+    _cache().pop(section, None)
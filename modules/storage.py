@@ -0,0 +1,227 @@
+# storage.py
+# DB バックエンドの切り替え層
+#   MEBIUS_DB_BACKEND=sqlite（既定）: db/*.db の SQLite ファイル
+#   MEBIUS_DB_BACKEND=postgres      : MEBIUS_DATABASE_URL の PostgreSQL（セクションごとにスキーマを分ける）
+# 各モジュールは ? プレースホルダの SQL をそのまま書き、接続は `with DB.connect() as conn:` で取得する
+#   （with を抜けると成功時は commit、例外時は rollback して必ず接続を返す）
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+
+BACKEND = os.environ.get("MEBIUS_DB_BACKEND", "sqlite")
+DATABASE_URL = os.environ.get("MEBIUS_DATABASE_URL", "")
+PG_POOL_MIN = int(os.environ.get("MEBIUS_PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.environ.get("MEBIUS_PG_POOL_MAX", "10"))
+PG_POOL_TIMEOUT_SEC = float(os.environ.get("MEBIUS_PG_POOL_TIMEOUT_SEC", "10"))
+
+# SQLite の全 DB・全接続に同じ設定を適用する
+SQLITE_PRAGMAS = [
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA busy_timeout=5000;",
+    "PRAGMA auto_vacuum=INCREMENTAL;",  # 新規 DB のみ即時反映（既存 DB は maintenance が VACUUM で切り替え）
+]
+
+DATABASES = []  # get_database() で作られた DB（maintenance が参照する）
+
+class PoolTimeout(Exception):
+    pass
+
+# -------------------------------
+# インターフェース
+# -------------------------------
+class Database(ABC):
+    IntegrityError = Exception
+
+    @abstractmethod
+    def connect(self):
+        """with 文で使える接続（cursor/execute/commit/close を持つ）を返す"""
+
+    @abstractmethod
+    def column_names(self, cursor, table: str):
+        """テーブルの列名一覧"""
+
+    @abstractmethod
+    def epoch_ms_sql(self, column: str, localtime: bool = False) -> str:
+        """日時列をエポックミリ秒に変換する SQL 式"""
+
+    def ddl(self, sql: str) -> str:
+        return sql
+
+    def add_column(self, cursor, table: str, column: str, decl: str):
+        if column not in self.column_names(cursor, table):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+    def sync_id_sequence(self, cursor, table: str):
+        """id を明示して INSERT した後に、自動採番をその続きから始めさせる（SQLite は不要）"""
+
+    def ensure_ms_column(self, cursor, table: str, column: str, source: str, localtime: bool = False):
+        # 既存の TEXT/DATETIME 列から整数ミリ秒列へ移行する（何度呼んでも安全）
+        self.add_column(cursor, table, column, "BIGINT")
+        cursor.execute(f"""
+            UPDATE {table}
+            SET {column} = {self.epoch_ms_sql(source, localtime)}
+            WHERE {column} IS NULL AND {source} IS NOT NULL
+        """)
+
+# -------------------------------
+# SQLite
+# -------------------------------
+class _SQLiteConnection(sqlite3.Connection):
+    # 標準の with は commit/rollback だけなので、抜けるときに close もする
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            return super().__exit__(exc_type, exc, tb)
+        finally:
+            self.close()
+
+class SQLiteDatabase(Database):
+    IntegrityError = sqlite3.IntegrityError
+
+    def __init__(self, path: str, name: str = None):
+        self.path = path
+        self.name = name or os.path.splitext(os.path.basename(path))[0]
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, factory=_SQLiteConnection)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def column_names(self, cursor, table):
+        return [row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+
+    def epoch_ms_sql(self, column, localtime=False):
+        modifier = ", 'utc'" if localtime else ""
+        return f"CAST(strftime('%s', {column}{modifier}) AS INTEGER) * 1000"
+
+# -------------------------------
+# PostgreSQL
+# -------------------------------
+class _PgCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, params=()):
+        if params:
+            self._cursor.execute(sql.replace("%", "%%").replace("?", "%s"), tuple(params))
+        else:
+            self._cursor.execute(sql)
+        return self
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+class _PgConnection:
+    # sqlite3.Connection と同じ使い方（cursor/execute/commit/close, with）ができるラッパー
+    def __init__(self, db):
+        self._db = db
+        # ThreadedConnectionPool は上限で待たずに PoolError を出すので、セマフォで空きを待つ
+        if not db.slots.acquire(timeout=PG_POOL_TIMEOUT_SEC):
+            raise PoolTimeout(f"{db.schema}: {PG_POOL_TIMEOUT_SEC} 秒待っても DB 接続が空きませんでした")
+        try:
+            self._conn = db.pool.getconn()
+        except Exception:
+            db.slots.release()
+            raise
+
+    def cursor(self):
+        return _PgCursor(self._conn.cursor())
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def commit(self):
+        self._conn.commit()
+
+    def close(self):
+        if self._conn is None:
+            return
+        try:
+            self._conn.rollback()
+            self._db.pool.putconn(self._conn)
+        except Exception:
+            self._db.pool.putconn(self._conn, close=True)
+        finally:
+            self._conn = None
+            self._db.slots.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.commit()
+        finally:
+            self.close()
+        return False
+
+class PostgresDatabase(Database):
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, dsn: str, schema: str):
+        import psycopg2
+        import psycopg2.pool
+        self.IntegrityError = psycopg2.IntegrityError
+        self.dsn = dsn
+        self.schema = schema
+        self.name = schema
+        with self._pools_lock:
+            if (dsn, schema) not in self._pools:
+                conn = psycopg2.connect(dsn)
+                conn.cursor().execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+                conn.commit()
+                conn.close()
+                pool = psycopg2.pool.ThreadedConnectionPool(
+                    PG_POOL_MIN, PG_POOL_MAX, dsn, options=f"-c search_path={schema}")
+                self._pools[(dsn, schema)] = (pool, threading.BoundedSemaphore(PG_POOL_MAX))
+        self.pool, self.slots = self._pools[(dsn, schema)]
+
+    def connect(self):
+        return _PgConnection(self)
+
+    def ddl(self, sql):
+        return (sql.replace("INTEGER PRIMARY KEY AUTOINCREMENT", "BIGSERIAL PRIMARY KEY")
+                   .replace("DATETIME", "TIMESTAMP"))
+
+    def column_names(self, cursor, table):
+        cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema=? AND table_name=?",
+                       (self.schema, table))
+        return [row[0] for row in cursor.fetchall()]
+
+    def add_column(self, cursor, table, column, decl):
+        # 複数レプリカが同時に init_db しても衝突しないように IF NOT EXISTS を使う
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {decl}")
+
+    def sync_id_sequence(self, cursor, table):
+        cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT MAX(id) FROM {table}))")
+
+    def epoch_ms_sql(self, column, localtime=False):
+        zone = "current_setting('TimeZone')" if localtime else "'UTC'"
+        return f"CAST(EXTRACT(EPOCH FROM CAST({column} AS TIMESTAMP) AT TIME ZONE {zone}) * 1000 AS BIGINT)"
+
+# -------------------------------
+# 設定による選択
+# -------------------------------
+def get_database(name: str, sqlite_path: str) -> Database:
+    if BACKEND == "postgres":
+        if not DATABASE_URL:
+            raise RuntimeError("MEBIUS_DB_BACKEND=postgres には MEBIUS_DATABASE_URL の設定が必要です")
+        db = PostgresDatabase(DATABASE_URL, name)
+    else:
+        db = SQLiteDatabase(sqlite_path, name)
+    DATABASES.append(db)
+    return db
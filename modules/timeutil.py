@@ -0,0 +1,15 @@
+# timeutil.py
+# 時刻は整数のエポックミリ秒（UTC）で保存・比較し、表示時だけ文字列にする
+import time
+import datetime
+
+def now_ms() -> int:
+    return time.time_ns() // 1_000_000
+
+def ms_ago(seconds: float) -> int:
+    return now_ms() - int(seconds * 1000)
+
+def ms_to_str(ms) -> str:
+    if ms is None:
+        return ""
+    return datetime.datetime.fromtimestamp(ms / 1000).strftime("%Y-%m-%d %H:%M:%S")
@@ -0,0 +1,53 @@
+# conftest.py
+# 契約テスト用: 同じテストを SQLite と PostgreSQL の両方で実行する
+#   PostgreSQL は MEBIUS_TEST_DATABASE_URL があればそれを使い、なければ pgserver でローカルに起動する
+import os
+import uuid
+import pytest
+from modules import storage, ratelimit
+
+SECTIONS = ("board", "chat", "karitunagari", "sessions")
+
+@pytest.fixture(scope="session")
+def postgres_url(tmp_path_factory):
+    url = os.environ.get("MEBIUS_TEST_DATABASE_URL")
+    if url:
+        return url
+    try:
+        import pgserver
+    except ImportError:
+        pytest.skip("PostgreSQL がありません（MEBIUS_TEST_DATABASE_URL を設定するか pgserver をインストール）")
+    server = pgserver.get_server(str(tmp_path_factory.mktemp("pgdata")), cleanup_mode="stop")
+    return server.get_uri()
+
+def _make_databases(backend, request, tmp_path):
+    if backend == "sqlite":
+        return {name: storage.SQLiteDatabase(str(tmp_path / f"{name}.db")) for name in SECTIONS}
+    url = request.getfixturevalue("postgres_url")
+    suffix = uuid.uuid4().hex[:8]
+    return {name: storage.PostgresDatabase(url, f"{name}_{suffix}") for name in SECTIONS}
+
+def _drop_postgres(db):
+    import psycopg2
+    db.pool.closeall()
+    del storage.PostgresDatabase._pools[(db.dsn, db.schema)]
+    conn = psycopg2.connect(db.dsn)
+    conn.autocommit = True
+    conn.cursor().execute(f"DROP SCHEMA IF EXISTS {db.schema} CASCADE")
+    conn.close()
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def backend(request, tmp_path, monkeypatch):
+    from modules import board, chat, karitunagari, sessions
+    databases = _make_databases(request.param, request, tmp_path)
+    for name, module in (("board", board), ("chat", chat), ("karitunagari", karitunagari), ("sessions", sessions)):
+        monkeypatch.setattr(module, "DB", databases[name])
+        monkeypatch.setattr(module, "_initialized", False)
+    # maintenance が実際の db/*.db に触れないようにする
+    monkeypatch.setattr(storage, "DATABASES", list(databases.values()))
+    ratelimit.reset()
+    yield databases
+    ratelimit.reset()
+    if request.param == "postgres":
+        for db in databases.values():
+            _drop_postgres(db)
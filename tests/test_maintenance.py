@@ -0,0 +1,114 @@
+# test_maintenance.py
+import os
+import sqlite3
+
+import pytest
+
+from modules import maintenance, storage
+
+@pytest.fixture
+def legacy_db(tmp_path, monkeypatch):
+    # auto_vacuum=NONE のまま作られた既存 DB（SQLITE_PRAGMAS を通さずに作る）
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE posts (id INTEGER PRIMARY KEY, body TEXT, ts_ms INTEGER)")
+    conn.execute("CREATE INDEX idx_posts_ts ON posts (ts_ms)")
+    conn.executemany("INSERT INTO posts (body, ts_ms) VALUES (?, ?)", [("x" * 500, i) for i in range(500)])
+    conn.commit()
+    conn.close()
+    db = storage.SQLiteDatabase(path)
+    monkeypatch.setattr(storage, "DATABASES", [db])
+    monkeypatch.setattr(maintenance, "_status", {})
+    return db
+
+def _pragma(db, name):
+    with db.connect() as conn:
+        return conn.execute(f"PRAGMA {name};").fetchone()[0]
+
+def test_vacuum_switches_to_incremental_once(legacy_db):
+    assert _pragma(legacy_db, "auto_vacuum") == 0
+    maintenance.vacuum(legacy_db)
+    assert _pragma(legacy_db, "auto_vacuum") == 2
+    assert maintenance._status[legacy_db.name]["vacuum"][1] == {"switched_to_incremental": True}
+    with legacy_db.connect() as conn:
+        conn.execute("DELETE FROM posts")
+    assert _pragma(legacy_db, "freelist_count") > 0
+    maintenance.vacuum(legacy_db)
+    assert maintenance._status[legacy_db.name]["vacuum"][1] == {"switched_to_incremental": False}
+    assert _pragma(legacy_db, "freelist_count") == 0
+
+def test_optimize_analyzes_then_uses_pragma_optimize(legacy_db):
+    maintenance.optimize(legacy_db)
+    with legacy_db.connect() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM sqlite_stat1").fetchone()[0] > 0
+    maintenance.optimize(legacy_db)
+    assert "optimize" in maintenance._status[legacy_db.name]
+
+def test_truncate_checkpoint_empties_the_wal(legacy_db):
+    # 最後の接続が閉じると WAL ファイルごと消えるので、アプリの接続が開いている状態を再現する
+    with legacy_db.connect() as reader:
+        reader.execute("SELECT COUNT(*) FROM posts").fetchone()
+        with legacy_db.connect() as conn:
+            conn.executemany("INSERT INTO posts (body, ts_ms) VALUES (?, ?)", [("y", i) for i in range(100)])
+        assert os.path.getsize(legacy_db.path + "-wal") > 0
+        maintenance.checkpoint(legacy_db, "PASSIVE")
+        assert maintenance._status[legacy_db.name]["checkpoint_passive"][1]["busy"] == 0
+        maintenance.checkpoint(legacy_db, "TRUNCATE")
+        assert os.path.getsize(legacy_db.path + "-wal") == 0
+
+def test_run_once_and_report(legacy_db, monkeypatch):
+    monkeypatch.setattr(maintenance, "_last_purge_ms", 2 ** 62)  # セッション DB には触れない
+    maintenance.run_once(deep=True)
+    status = maintenance._status[legacy_db.name]
+    assert {"optimize", "vacuum", "checkpoint_truncate"} <= set(status)
+    [row] = maintenance.report()
+    assert row["db"] == legacy_db.name
+    assert row["db_bytes"] == os.path.getsize(legacy_db.path)
+    assert row["wal_bytes"] == 0
+    assert row["last_checkpoint"] and row["last_optimize"]
+    assert row["last_error"] == ""
+
+def test_run_once_records_task_errors(legacy_db, monkeypatch):
+    def broken(db, mode="PASSIVE"):
+        raise OSError("wal gone")
+    monkeypatch.setattr(maintenance, "_last_purge_ms", 2 ** 62)
+    monkeypatch.setattr(maintenance, "checkpoint", broken)
+    maintenance.run_once(deep=False)
+    assert maintenance.report()[0]["last_error"] == "wal gone"
+
+@pytest.mark.parametrize("value, hours", [("3-5", (3, 5)), ("22-4", (22, 4)), ("0-24", (0, 24))])
+def test_low_traffic_hours_are_parsed(value, hours):
+    assert maintenance._parse_hours(value) == hours
+
+@pytest.mark.parametrize("value", ["", "3", "3-", "a-b", "3-25", "-1-5"])
+def test_bad_low_traffic_hours_fail_early(value):
+    with pytest.raises(ValueError):
+        maintenance._parse_hours(value)
+
+def test_loop_survives_unexpected_errors(monkeypatch):
+    calls = []
+
+    def run_once():
+        calls.append(1)
+        if len(calls) == 1:
+            raise OSError("disk gone")
+        raise SystemExit  # ループを抜けるため（Exception ではないので握りつぶされない）
+
+    monkeypatch.setattr(maintenance, "CHECKPOINT_INTERVAL_SEC", 0)
+    monkeypatch.setattr(maintenance, "run_once", run_once)
+    monkeypatch.setattr(maintenance, "_status", {})
+    with pytest.raises(SystemExit):
+        maintenance._loop()
+    assert len(calls) == 2
+    assert maintenance._status["scheduler"]["error"][1] == {"message": "OSError: disk gone"}
+
+def test_start_replaces_a_dead_thread(monkeypatch):
+    class DeadThread:
+        def is_alive(self):
+            return False
+
+    started = []
+    monkeypatch.setattr(maintenance, "_thread", DeadThread())
+    monkeypatch.setattr(maintenance.threading.Thread, "start", lambda self: started.append(self))
+    maintenance.start()
+    assert started and maintenance._thread is started[0]
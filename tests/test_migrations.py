@@ -0,0 +1,83 @@
+# test_migrations.py
+# 旧スキーマ（TEXT/DATETIME の時刻列、初期の db/chat.db）からの移行
+import datetime
+import os
+import shutil
+
+from modules import board, chat, karitunagari, storage
+
+REPO_DB_DIR = os.path.join(os.path.dirname(__file__), os.pardir, "db")
+
+def _utc_ms(text):
+    return int(datetime.datetime.strptime(text, "%Y-%m-%d %H:%M:%S")
+               .replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+def test_chat_backfills_ts_ms_from_datetime(backend):
+    with chat.DB.connect() as conn:
+        conn.execute(chat.DB.ddl('''CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, sender TEXT, receiver TEXT, message TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)'''))
+        conn.execute("INSERT INTO messages (sender, receiver, message, timestamp) VALUES (?, ?, ?, ?)",
+                     ("a", "b", "old", "2025-09-11 08:34:11"))
+    chat.init_db()
+    chat.save_message("b", "a", "new")
+    messages = chat.get_messages("a", "b")
+    assert [(m[1], m[2]) for m in messages][0] == ("old", _utc_ms("2025-09-11 08:34:11"))
+    assert [m[1] for m in messages] == ["old", "new"]
+
+def test_kari_backfills_ts_ms_from_datetime(backend):
+    with karitunagari.DB.connect() as conn:
+        conn.execute(karitunagari.DB.ddl('''CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, kari_id TEXT, partner_id TEXT, message TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, topic_theme TEXT)'''))
+        conn.execute("INSERT INTO messages (kari_id, partner_id, message, timestamp) VALUES (?, ?, ?, ?)",
+                     ("x", "y", "old", "2025-09-11 08:34:11"))
+    karitunagari.init_db()
+    assert karitunagari.get_messages_since("x", "y", _utc_ms("2025-09-11 08:34:11"))[0][1] == "old"
+    assert karitunagari.get_messages_since("x", "y", _utc_ms("2025-09-11 08:34:12")) == []
+
+def test_board_backfills_created_ms_from_local_text(backend):
+    with board.DB.connect() as conn:
+        conn.execute(board.DB.ddl("CREATE TABLE threads (id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT, created_at TEXT)"))
+        conn.execute(board.DB.ddl('''CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, message TEXT, timestamp TEXT, thread_id INTEGER)'''))
+        conn.execute("INSERT INTO threads (title, created_at) VALUES (?, ?)", ("古いスレ", "2025-01-01 00:00:00"))
+        conn.execute("INSERT INTO messages (username, message, timestamp, thread_id) VALUES (?, ?, ?, 1)",
+                     ("taro", "やあ", "2025-01-01 00:01:30"))
+    board.init_db()
+    with board.DB.connect() as conn:
+        created = conn.execute("SELECT created_ms FROM threads WHERE title=?", ("古いスレ",)).fetchone()[0]
+        posted = conn.execute("SELECT ts_ms, flagged FROM messages").fetchone()
+    # ローカル時刻として解釈されるのでタイムゾーンによらず差だけを比べる
+    assert posted[0] - created == 90 * 1000
+    assert posted[1] == 0
+    assert [t[1] for t in board.load_threads()] == ["古いスレ"]
+
+def test_legacy_chat_tables_are_set_aside(backend):
+    with chat.DB.connect() as conn:
+        conn.execute("CREATE TABLE users (kari_id TEXT PRIMARY KEY, password TEXT)")
+        conn.execute(chat.DB.ddl('''CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, kari_id TEXT, partner_id TEXT, message TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, topic_theme TEXT)'''))
+        conn.execute("INSERT INTO messages (kari_id, partner_id, message) VALUES (?, ?, ?)", ("x", "y", "old"))
+    chat.init_db()
+    assert chat.save_message("a", "b", "new")
+    assert [m[1] for m in chat.get_messages("a", "b")] == ["new"]
+    with chat.DB.connect() as conn:
+        assert conn.execute("SELECT message FROM legacy_messages").fetchall() == [("old",)]
+
+def test_legacy_chat_db_is_set_aside(tmp_path, monkeypatch):
+    # リポジトリに含まれる初期の db/chat.db（仮つながりと同じ形）のコピーで初期化できること
+    path = tmp_path / "chat.db"
+    shutil.copy(os.path.join(REPO_DB_DIR, "chat.db"), path)
+    monkeypatch.setattr(chat, "DB", storage.SQLiteDatabase(str(path)))
+    monkeypatch.setattr(chat, "_initialized", False)
+    with chat.DB.connect() as conn:
+        legacy_count = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+    chat.init_db()
+    assert chat.register_user("a", "pw")
+    assert chat.save_message("a", "b", "hello")
+    assert [m[1] for m in chat.get_messages("a", "b")] == ["hello"]
+    with chat.DB.connect() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM legacy_messages").fetchone()[0] == legacy_count
+        assert "kari_id" in chat.DB.column_names(conn.cursor(), "legacy_users")
@@ -0,0 +1,89 @@
+# test_moderation.py
+import os
+import random
+
+import pytest
+
+from modules import moderation
+
+@pytest.fixture
+def words(tmp_path, monkeypatch):
+    path = tmp_path / "ng_words.txt"
+    path.write_text("# コメント\nバカ\nアホ\nabc\n", encoding="utf-8")
+    monkeypatch.setattr(moderation, "NG_WORDS_FILE", str(path))
+    moderation.reload()
+    yield path
+    monkeypatch.undo()
+    moderation.reload()
+
+def test_ng_words_are_masked_across_width_and_case(words):
+    assert moderation.moderate("お前バカだな") == (True, "お前＊＊だな", ["ng_word"])
+    assert moderation.moderate("ｱﾎか") == (True, "＊＊か", ["ng_word"])
+    assert moderation.moderate("ばかだな") == (True, "＊＊だな", ["ng_word"])
+    assert moderation.moderate("ＡＢＣです") == (True, "＊＊＊です", ["ng_word"])
+
+def test_half_width_dakuten_is_composed_before_matching(words):
+    # ﾊﾞｶ は 3 文字だがバカの 2 文字に正規化される。伏せ字は元の 3 文字すべてに掛かる
+    assert moderation.moderate("ﾊﾞｶ!") == (True, "＊＊＊!", ["ng_word"])
+    assert moderation.moderate("ﾊｶ") == (True, "ﾊｶ", [])
+
+@pytest.mark.parametrize("text", [
+    "090-1234-5678",
+    "03-1234-5678",
+    "(03)1234-5678",
+    "０９０－１２３４－５６７８",
+    "電話は09012345678まで",
+    "0312345678",
+    "090 1234 5678",
+    "090.1234.5678",
+    "(03) 1234 5678",
+    "+81-90-1234-5678",
+    "+81 90 1234 5678",
+    "+819012345678",
+    "+81 (0)3 1234 5678",
+    "0120-123-456",
+    "0800-123-456",
+    "0800-123-4567",
+])
+def test_phone_numbers_are_rejected(words, text):
+    assert moderation.moderate(text) == (False, text, ["phone"])
+
+@pytest.mark.parametrize("text", [
+    "会議は01-01-2025に",
+    "スコア 012345",
+    "2024-01-01 12:30",
+    "部屋番号 0123",
+    "090-1234-56789",
+    "01-01-2025-1234",
+    "0120-12-345",
+    "v0.1 2025.01.01",
+    "+81-1234",
+])
+def test_dates_and_short_numbers_are_not_phones(words, text):
+    assert moderation.moderate(text) == (True, text, [])
+
+def test_email_is_rejected(words):
+    allowed, _, kinds = moderation.moderate("連絡は taro@example.com へ")
+    assert not allowed and kinds == ["email"]
+    assert moderation.reject_message(kinds)
+
+def test_flag_becomes_mask_when_not_allowed(words, monkeypatch):
+    monkeypatch.setitem(moderation.POLICY, "ng_word", "flag")
+    allowed, text, kinds = moderation.moderate("バカ")
+    assert (allowed, text) == (True, "バカ") and moderation.is_flagged(kinds)
+    assert moderation.moderate("バカ", allow_flag=False) == (True, "＊＊", ["ng_word"])
+
+def test_word_list_is_reloaded_when_file_changes(words):
+    assert moderation.moderate("ブス")[2] == []
+    words.write_text("ブス\n", encoding="utf-8")
+    mtime = os.path.getmtime(words) + 10
+    os.utime(words, (mtime, mtime))
+    assert moderation.moderate("ブス") == (True, "＊＊", ["ng_word"])
+
+def test_automaton_matches_naive_search():
+    rng = random.Random(0)
+    for _ in range(200):
+        patterns = {"".join(rng.choices("ab", k=rng.randint(1, 4))) for _ in range(rng.randint(1, 5))}
+        text = "".join(rng.choices("ab", k=rng.randint(0, 20)))
+        expected = {(i, i + len(p)) for p in patterns for i in range(len(text)) if text.startswith(p, i)}
+        assert set(moderation.Automaton(patterns).find(text)) == expected
@@ -0,0 +1,71 @@
+# test_ratelimit.py
+from types import SimpleNamespace
+
+import pytest
+import streamlit as st
+
+from modules import ratelimit
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now[0])
+    monkeypatch.setitem(ratelimit.LIMITS, "test.action", (3, 0.5))
+    ratelimit.reset()
+    yield now
+    ratelimit.reset()
+
+def test_capacity_then_refill(clock):
+    assert [ratelimit.allow("test.action", "u") for _ in range(4)] == [True, True, True, False]
+    clock[0] += 1.9
+    assert not ratelimit.allow("test.action", "u")
+    clock[0] += 0.1
+    assert ratelimit.allow("test.action", "u")
+    clock[0] += 100
+    assert [ratelimit.allow("test.action", "u") for _ in range(4)] == [True, True, True, False]
+
+def test_rejections_are_counted(clock):
+    for _ in range(5):
+        ratelimit.allow("test.action", "u")
+    assert ratelimit.stats() == {"test.action": {"allowed": 3, "rejected": 2}}
+
+def test_each_key_has_its_own_bucket(clock):
+    for _ in range(3):
+        assert ratelimit.allow("test.action", "a")
+    assert not ratelimit.allow("test.action", "a")
+    assert ratelimit.allow("test.action", "b")
+    assert ratelimit.allow("other.action", "a")
+
+def test_configure_replaces_the_limit(clock):
+    for _ in range(3):
+        ratelimit.allow("test.action", "u")
+    ratelimit.configure("test.action", 1, 0)
+    assert ratelimit.allow("test.action", "u")
+    clock[0] += 1000
+    assert not ratelimit.allow("test.action", "u")
+
+def test_buckets_are_bounded(clock, monkeypatch):
+    monkeypatch.setattr(ratelimit, "MAX_BUCKETS", 10)
+    for i in range(100):
+        ratelimit.allow("test.action", f"k{i}")
+    assert len(ratelimit._buckets) <= 10
+    # 満タンに戻ったバケットは捨てられる
+    clock[0] += 10
+    ratelimit.allow("test.action", "new")
+    assert list(ratelimit._buckets) == [("test.action", "new")]
+
+def _context(monkeypatch, headers, ip):
+    monkeypatch.setattr(st, "context", SimpleNamespace(headers=headers, ip_address=ip))
+
+def test_forwarded_for_is_ignored_without_a_trusted_proxy(monkeypatch):
+    _context(monkeypatch, {"X-Forwarded-For": "6.6.6.6"}, "10.0.0.5")
+    assert ratelimit.client_key() == "ip:10.0.0.5"
+
+def test_forwarded_for_is_read_behind_trusted_proxies(monkeypatch):
+    monkeypatch.setattr(ratelimit, "TRUSTED_PROXY_HOPS", 1)
+    _context(monkeypatch, {"X-Forwarded-For": "6.6.6.6, 203.0.113.7"}, "10.0.0.5")
+    assert ratelimit.client_key() == "ip:203.0.113.7"
+    monkeypatch.setattr(ratelimit, "TRUSTED_PROXY_HOPS", 2)
+    assert ratelimit.client_key() == "ip:6.6.6.6"
+    _context(monkeypatch, {}, "10.0.0.5")
+    assert ratelimit.client_key() == "ip:10.0.0.5"
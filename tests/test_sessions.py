@@ -0,0 +1,48 @@
+# test_sessions.py
+from modules import board, chat, maintenance, sessions
+
+def test_login_is_scoped_to_its_section(backend):
+    chat.init_db()
+    assert chat.register_user(board.ADMIN_USER, "x")
+    assert chat.login_user(board.ADMIN_USER, "x")
+    token = sessions.create_session("chat", board.ADMIN_USER)
+    assert sessions.get_session_user(token, "chat") == board.ADMIN_USER
+    assert sessions.get_session_user(token, "board") is None
+    assert sessions.get_session_user(token, "karitunagari") is None
+
+def test_one_token_carries_each_section_login(backend):
+    old = sessions.create_session("board", "taro")
+    token = sessions.create_session("karitunagari", "赤い猫", old)
+    assert token != old
+    assert sessions.get_session_user(old, "board") is None
+    assert sessions.get_session_user(token, "board") == "taro"
+    assert sessions.get_session_user(token, "karitunagari") == "赤い猫"
+    sessions.delete_session(token, "board")
+    assert sessions.get_session_user(token, "board") is None
+    assert sessions.get_session_user(token, "karitunagari") == "赤い猫"
+    sessions.delete_session(token)
+    assert sessions.get_session_user(token, "karitunagari") is None
+
+def test_login_does_not_extend_a_planted_token(backend):
+    # 攻撃者が自分のトークンを ?sid= に仕込んだリンクを送っても、被害者のログインは攻撃者のトークンに載らない
+    planted = sessions.create_session("board", "attacker")
+    victim = sessions.create_session("chat", "victim", planted)
+    assert sessions.get_session_user(planted, "chat") is None
+    assert sessions.get_session_user(planted, "board") is None
+    assert sessions.get_session_user(victim, "chat") == "victim"
+
+def test_tampered_or_foreign_tokens_are_rejected(backend):
+    token = sessions.create_session("board", "taro")
+    session_id, _, sig = token.partition(".")
+    assert sessions.get_session_user(f"{session_id}.{'0' * len(sig)}", "board") is None
+    assert sessions.get_session_user("junk", "board") is None
+    assert sessions.create_session("chat", "b", "junk") != token
+
+def test_expired_sessions_are_purged(backend, monkeypatch):
+    monkeypatch.setattr(sessions, "SESSION_TTL_SEC", 0)
+    token = sessions.create_session("board", "taro")
+    assert sessions.get_session_user(token, "board") is None
+    monkeypatch.setattr(maintenance, "_last_purge_ms", 0)
+    maintenance.run_once(deep=False)
+    assert maintenance._status[sessions.DB.name]["purge_sessions"][1] == {"deleted": 1}
+    assert sessions.purge_expired() == 0
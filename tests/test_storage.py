@@ -0,0 +1,75 @@
+# test_storage.py
+# 接続の後始末とプール上限の扱い
+import sqlite3
+import threading
+import pytest
+from modules import storage
+
+def test_sqlite_connection_closes_on_exit(tmp_path):
+    db = storage.SQLiteDatabase(str(tmp_path / "t.db"))
+    with db.connect() as conn:
+        conn.execute("CREATE TABLE t (x INTEGER)")
+        conn.execute("INSERT INTO t VALUES (1)")
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute("SELECT 1")
+    with db.connect() as conn:
+        assert conn.execute("SELECT x FROM t").fetchall() == [(1,)]
+
+def test_sqlite_rolls_back_on_error(tmp_path):
+    db = storage.SQLiteDatabase(str(tmp_path / "t.db"))
+    with db.connect() as conn:
+        conn.execute("CREATE TABLE t (x INTEGER)")
+    with pytest.raises(ZeroDivisionError):
+        with db.connect() as conn:
+            conn.execute("INSERT INTO t VALUES (1)")
+            1 / 0
+    with db.connect() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0
+
+@pytest.fixture
+def pg(postgres_url):
+    import psycopg2
+    db = storage.PostgresDatabase(postgres_url, "pooltest")
+    yield db
+    db.pool.closeall()
+    del storage.PostgresDatabase._pools[(db.dsn, db.schema)]
+    conn = psycopg2.connect(postgres_url)
+    conn.autocommit = True
+    conn.cursor().execute("DROP SCHEMA IF EXISTS pooltest CASCADE")
+    conn.close()
+
+def test_postgres_errors_do_not_leak_connections(pg):
+    for _ in range(storage.PG_POOL_MAX * 2):
+        with pytest.raises(Exception):
+            with pg.connect() as conn:
+                conn.execute("SELECT * FROM no_such_table")
+    with pg.connect() as conn:
+        assert conn.execute("SELECT 1").fetchone() == (1,)
+
+def test_postgres_pool_waits_for_free_connection(pg, monkeypatch):
+    monkeypatch.setattr(storage, "PG_POOL_TIMEOUT_SEC", 0.2)
+    held = [pg.connect() for _ in range(storage.PG_POOL_MAX)]
+    with pytest.raises(storage.PoolTimeout):
+        pg.connect()
+
+    monkeypatch.setattr(storage, "PG_POOL_TIMEOUT_SEC", 5)
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(pg.connect()))
+    waiter.start()
+    held.pop().close()
+    waiter.join(5)
+    assert len(result) == 1
+    for conn in held + result:
+        conn.close()
+
+def test_postgres_add_column_is_idempotent(pg):
+    with pg.connect() as conn:
+        c = conn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS t (x INTEGER)")
+        pg.add_column(c, "t", "y", "BIGINT")
+        pg.add_column(c, "t", "y", "BIGINT")
+        assert pg.column_names(c, "t") == ["x", "y"]
+
+def test_database_is_abstract():
+    with pytest.raises(TypeError):
+        storage.Database()
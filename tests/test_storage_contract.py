@@ -0,0 +1,128 @@
+# test_storage_contract.py
+# board / chat / karitunagari の DB 操作が SQLite・PostgreSQL で同じ結果になることを確認する
+from modules import board, chat, karitunagari
+
+# -------------------------------
+# 掲示板
+# -------------------------------
+def test_board_users(backend):
+    board.init_db()
+    board.init_db()
+    assert board.check_user(board.ADMIN_USER, board.ADMIN_PASS)
+    assert board.register_user("taro", "pw") == "OK"
+    assert board.register_user("taro", "pw") != "OK"
+    assert board.register_user(" ", "pw") != "OK"
+    assert board.check_user("taro", "pw")
+    assert not board.check_user("taro", "wrong")
+    assert not board.check_user("nobody", "pw")
+    assert sorted(board.list_users()) == sorted([board.ADMIN_USER, "taro"])
+
+def test_board_threads(backend):
+    board.init_db()
+    assert [t[1] for t in board.load_threads()] == ["雑談スレ"]
+    assert board.create_thread("猫スレ", "taro")
+    titles = [t[1] for t in board.load_threads()]
+    assert titles == ["猫スレ", "雑談スレ"]
+    assert [t[1] for t in board.load_threads("猫")] == ["猫スレ"]
+    assert len(board.load_threads_since(0)) == 2
+    assert board.load_threads_since(2 ** 62) == []
+
+def test_board_init_is_safe_across_replicas(backend):
+    # 別レプリカが先に既定スレと admin を作っていても、重複も IntegrityError も起きない
+    with board.DB.connect() as conn:
+        conn.execute(board.DB.ddl("CREATE TABLE users (username TEXT PRIMARY KEY, password TEXT)"))
+        conn.execute("INSERT INTO users (username, password) VALUES (?, ?)",
+                     (board.ADMIN_USER, board.hash_password(board.ADMIN_PASS)))
+    board.init_db()
+    board._initialized = False
+    board.init_db()
+    assert [t[1] for t in board.load_threads()] == ["雑談スレ"]
+    assert board.check_user(board.ADMIN_USER, board.ADMIN_PASS)
+    assert board.create_thread("猫スレ", "taro")
+    assert sorted(t[0] for t in board.load_threads()) == [1, 2]
+
+def test_board_messages(backend):
+    board.init_db()
+    assert board.save_message("taro", "one", 1)
+    assert board.save_message("hanako", "two", 1, flagged=True)
+    messages = board.load_messages(1)
+    assert [(m[1], m[2], m[4]) for m in messages] == [("hanako", "two", True), ("taro", "one", False)]
+    assert board.load_messages_since(1, 0) == messages
+    assert [m[5] for m in board.load_recent_messages()] == [1, 1]
+    board.delete_message(messages[0][0])
+    assert [m[2] for m in board.load_messages(1)] == ["one"]
+    board.delete_all_messages()
+    assert board.load_messages(1) == []
+
+# -------------------------------
+# 1:1 チャット
+# -------------------------------
+def test_chat_users(backend):
+    chat.init_db()
+    assert chat.register_user("a", "pw")
+    assert not chat.register_user("a", "pw")
+    assert chat.login_user("a", "pw")
+    assert not chat.login_user("a", "wrong")
+    assert not chat.login_user("nobody", "pw")
+
+def test_chat_messages_and_unread(backend, monkeypatch):
+    chat.init_db()
+    clock = iter(range(1000, 2000))  # 同じミリ秒に重ならないよう時刻を固定で進める
+    monkeypatch.setattr(chat, "now_ms", lambda: next(clock))
+    chat.save_message("a", "b", "1")
+    chat.save_message("b", "a", "2")
+    chat.save_message("a", "b", "3")
+    messages = chat.get_messages("a", "b")
+    assert [m[1] for m in messages] == ["1", "2", "3"]
+    assert [m[1] for m in chat.get_messages_since("a", "b", messages[1][2])] == ["2", "3"]
+    assert chat.get_unread_counts("b") == {"a": 2}
+    assert chat.get_read_cursor("b", "a") == 0
+    chat.mark_read("b", "a", messages[0][3])
+    assert chat.get_unread_counts("b") == {"a": 1}
+    assert chat.get_read_cursor("b", "a") == messages[0][3]
+    chat.mark_read("b", "a", messages[-1][3])
+    assert chat.get_unread_counts("b") == {}
+    assert chat.get_read_cursor("b", "a") == messages[-1][3]
+
+def test_chat_friends(backend):
+    chat.init_db()
+    assert chat.add_friend("a", "b")
+    assert not chat.add_friend("a", "b")
+    assert chat.get_friends("a") == ["b"]
+    assert chat.get_friends("b") == []
+
+# -------------------------------
+# 仮つながりスペース
+# -------------------------------
+def test_kari_users(backend):
+    karitunagari.init_db()
+    assert karitunagari.register_user("赤い猫", "pw")
+    assert not karitunagari.register_user("赤い猫", "pw")
+    assert karitunagari.login_user("赤い猫", "pw")
+    assert not karitunagari.login_user("赤い猫", "wrong")
+
+def test_kari_messages_and_unread(backend):
+    karitunagari.init_db()
+    karitunagari.save_message("x", "y", "m", "猫")
+    karitunagari.save_message("y", "x", "n")
+    messages = karitunagari.get_messages("x", "y")
+    assert [(m[0], m[1]) for m in messages] == [("x", "m"), ("y", "n")]
+    assert karitunagari.get_messages_since("x", "y", 0) == messages
+    assert karitunagari.get_shared_theme("x", "y") == "猫"
+    assert karitunagari.get_shared_theme("x", "z") is None
+    assert karitunagari.get_unread_counts("y") == {"x": 1}
+    assert karitunagari.get_read_cursor("y", "x") == 0
+    karitunagari.mark_read("y", "x", messages[-1][2])
+    assert karitunagari.get_unread_counts("y") == {}
+    assert karitunagari.get_read_cursor("y", "x") == messages[-1][2]
+
+def test_kari_friend_requests(backend):
+    karitunagari.init_db()
+    assert karitunagari.send_friend_request("x", "y")
+    assert not karitunagari.send_friend_request("x", "y")
+    assert karitunagari.get_received_requests("y") == ["x"]
+    assert karitunagari.approve_friend_request("y", "x")
+    assert karitunagari.approve_friend_request("y", "x")
+    assert karitunagari.get_received_requests("y") == []
+    assert karitunagari.get_friends("y") == ["x"]
+    assert karitunagari.get_friends("x") == ["y"]